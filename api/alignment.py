@@ -0,0 +1,109 @@
+import math
+import numpy as np
+from settings import DTW_BAND, DTW_ENERGY_WEIGHT
+
+"""
+Dynamic time warping of contours.
+Aligns the frames of one contour (ie. a student's pitch and energy) to another (a native reference or a template).
+Only the cells within a Sakoe-Chiba band around the diagonal are filled, and they are filled one anti-diagonal
+at a time: every cell on an anti-diagonal only depends on the two anti-diagonals before it, so each one is
+a single vectorized numpy step and the whole alignment costs O((n + m) * band) instead of O(n * m) python steps.
+Only the band is stored, too: each row keeps the few columns the band crosses, so memory grows with n * band
+rather than n * m.
+"""
+
+def normalize_contour(contour, energy, energy_weight=DTW_ENERGY_WEIGHT):
+    """Given a pitch contour (midi, nan where unvoiced) and an energy envelope (0 to 1), returns (frames, 2) features.
+    Unvoiced gaps are filled in from the voiced frames around them, and the pitch is centered on its median
+    and scaled by its spread, so two speakers with different registers produce comparable shapes."""
+    contour = np.asarray(contour, dtype=float)
+    energy = np.asarray(energy, dtype=float)
+    voiced = np.isfinite(contour)
+
+    if voiced.any():
+        frames = np.arange(len(contour))
+        pitch = np.interp(frames, frames[voiced], contour[voiced])
+        pitch = pitch - np.median(pitch)
+        spread = np.std(pitch)
+        if spread > 1e-6:
+            pitch = pitch / spread
+    else:
+        pitch = np.zeros(len(contour))
+
+    return np.column_stack((pitch, energy_weight * energy))
+
+def band_radius(n, m, band=DTW_BAND):
+    """Returns how many cells either side of the diagonal the band keeps. Always wide enough for a path to exist."""
+    return max(band * max(n, m), m / n, 1.0)
+
+class BandedMatrix():
+    """
+    The accumulated cost matrix of banded_dtw, (n + 1, m + 1) with a row and column of padding,
+    storing only the columns of each row that the band crosses. Cells that were never filled are infinite.
+    """
+    def __init__(self, n, m, slope, radius):
+        self.shape = (n + 1, m + 1)
+        # row i starts at column offsets[i] - 1, one to the left of the band |j - i * slope| <= radius, and is wide
+        # enough to also hold the band of row i + 1: every cell a band cell reads is stored, so no read needs a bounds check.
+        self.offsets = np.maximum(np.ceil(np.arange(n + 1) * slope - radius), 0).astype(int) - 1
+        width = int(math.floor(2 * radius)) + int(math.ceil(slope)) + 4
+        self.cells = np.full((n + 1, width), np.inf)
+
+    def __getitem__(self, index):
+        i, j = index
+        return self.cells[i, j - self.offsets[i]]
+
+    def __setitem__(self, index, values):
+        i, j = index
+        self.cells[i, j - self.offsets[i]] = values
+
+def banded_dtw(x, y, band=DTW_BAND):
+    """Aligns the rows of x (n, features) to the rows of y (m, features) by squared euclidean distance.
+    Returns (x_frames, y_frames), the warping path as two parallel, non-decreasing arrays from (0, 0) to (n - 1, m - 1)."""
+    n, m = len(x), len(y)
+    radius = band_radius(n, m, band)
+    slope = m / n
+
+    # accumulated cost, with a row and column of padding so the first cells need no special case.
+    D = BandedMatrix(n, m, slope, radius)
+    D[0, 0] = 0
+
+    for d in range(2, n + m + 1):
+        # cells (i, j) with i + j == d, 1-based, kept inside the array and inside the band |j - i * slope| <= radius
+        low = max(1, d - m, math.ceil((d - radius) / (1 + slope)))
+        high = min(n, d - 1, math.floor((d + radius) / (1 + slope)))
+        if high < low:
+            continue
+        i = np.arange(low, high + 1)
+        j = d - i
+
+        cost = np.sum((x[i - 1] - y[j - 1]) ** 2, axis=1)
+        D[i, j] = cost + np.minimum(np.minimum(D[i - 1, j], D[i, j - 1]), D[i - 1, j - 1])
+
+    return _backtrack(D)
+
+def _backtrack(D):
+    """Walks the accumulated cost matrix back from the end to (1, 1). Returns the 0-based path."""
+    i, j = D.shape[0] - 1, D.shape[1] - 1
+    x_frames, y_frames = [i - 1], [j - 1]
+    while i > 1 or j > 1:
+        steps = ((i - 1, j - 1), (i - 1, j), (i, j - 1))
+        i, j = min(steps, key=lambda step: D[step])
+        x_frames.append(i - 1)
+        y_frames.append(j - 1)
+    return np.array(x_frames[::-1]), np.array(y_frames[::-1])
+
+def map_boundaries(path, boundaries, n):
+    """Given a warping path from banded_dtw, the mora boundaries (frames) of the contour it was aligned to, and the
+    number of frames n of the contour being split, returns the matching boundaries in that contour.
+    The first boundary is always 0 and the last always n, and every mora keeps at least one frame."""
+    x_frames, y_frames = path
+    boundaries = np.asarray(boundaries)
+    inner = x_frames[np.minimum(np.searchsorted(y_frames, boundaries[1:-1]), len(x_frames) - 1)]
+    mapped = np.concatenate(([0], inner, [n]))
+
+    # no empty mora: b[k] - k must be non-decreasing for the boundaries to be strictly increasing.
+    # (a recording shorter than one frame per mora can't manage that, so it keeps whatever room there is.)
+    k = np.arange(len(mapped))
+    slack = max(n - (len(mapped) - 1), 0)
+    return np.clip(np.maximum.accumulate(mapped - k), 0, slack) + np.minimum(k, n)
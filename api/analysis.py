@@ -1,14 +1,18 @@
 import librosa
 import numpy as np
-from settings import PITCH_TOLERANCE, HOP_LENGTH, FMIN, FMAX, MINIMUM_DELTA, N_FFT
+from settings import PITCH_TOLERANCE, HOP_LENGTH, FMIN, FMAX, MINIMUM_DELTA, N_FFT, SAMPLING_RATE
+from settings import PITCH_ESTIMATOR, PITCH_FRAME_LENGTH, VOICED_TOP_DB, PITCH_TRIM_PROPORTION
 
 COMMONLY_DEVOICED_MORA = ["く", "す", "っ"]
 
-def get_pitch_info(filename):
-    """Given an audio file to load, returns a pitch in midi."""
+def get_pitch_info(filename, sampling_rate=SAMPLING_RATE):
+    """Given an audio file to load, or an already loaded clip, returns a pitch in midi."""
     # note: y is audio signal in a 1D array
     # sr = sampling rate in Hz (ie. 44100 Hz)
-    y, sr = librosa.load(filename)
+    if isinstance(filename, str):
+        y, sr = librosa.load(filename)
+    else:
+        y, sr = filename, sampling_rate
 
     pitches, magnitudes = librosa.core.piptrack(y=y, sr=sr, hop_length=HOP_LENGTH, n_fft=N_FFT)
     # pitches, magnitudes = librosa.core.piptrack(y=y, sr=sr, hop_length=HOP_LENGTH, fmin=FMIN, fmax=FMAX)
@@ -26,6 +30,70 @@ def get_pitch_info(filename):
 
     return median_pitch_midi
 
+def get_pitch_contour(y, sr=SAMPLING_RATE):
+    """Given the signal of a whole utterance, returns a tuple (f0, voiced) with one value per HOP_LENGTH frame.
+    f0 is the fundamental frequency in Hz, and voiced is a boolean array flagging the frames that carry voice.
+    Frames line up with librosa.stft(y, hop_length=HOP_LENGTH), so frame i is centered on sample i * HOP_LENGTH."""
+    if PITCH_ESTIMATOR == "pyin":
+        # probabilistic yin. more robust voicing decisions, but several times slower.
+        f0, voiced, _ = librosa.pyin(y, fmin=FMIN, fmax=FMAX, sr=sr, frame_length=PITCH_FRAME_LENGTH, hop_length=HOP_LENGTH)
+        f0 = np.nan_to_num(f0, nan=0.0)
+    else:
+        f0 = librosa.yin(y, fmin=FMIN, fmax=FMAX, sr=sr, frame_length=PITCH_FRAME_LENGTH, hop_length=HOP_LENGTH)
+        rms = librosa.feature.rms(y=y, frame_length=PITCH_FRAME_LENGTH, hop_length=HOP_LENGTH)[0]
+        voiced = voiced_frames(rms)
+
+    return f0, voiced
+
+def voiced_frames(rms):
+    """Given the rms of each frame, flags the frames loud enough (relative to the loudest frame) to count as voiced.
+    yin always returns a pitch, so this is how its unvoiced frames are told apart."""
+    return librosa.amplitude_to_db(rms, ref=np.max) > -VOICED_TOP_DB
+
+def mora_pitch_statistics(f0, voiced, frame_bounds, trim_proportion=PITCH_TRIM_PROPORTION):
+    """Given a pitch contour from get_pitch_contour and the (first, last + 1) frames of each mora,
+    returns a dict of arrays with one entry per mora:
+    median and trimmed_mean are the pitch in midi over the voiced frames of the mora,
+    voiced_fraction is the share of the mora's frames that are voiced.
+    Everything is computed with segment reductions over the whole contour, no per-mora loop.
+    A mora without voiced frames falls back to the median over all of its frames."""
+    frame_bounds = np.asarray(frame_bounds, dtype=int).reshape(-1, 2)
+    starts = frame_bounds[:, 0]
+    lengths = np.maximum(frame_bounds[:, 1] - starts, 1)
+    n_segments = len(frame_bounds)
+
+    # gather the frames of every mora into one flat array, tagged with the mora they belong to.
+    segment_ids = np.repeat(np.arange(n_segments), lengths)
+    segment_starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    frame_idx = starts[segment_ids] + np.arange(lengths.sum()) - segment_starts[segment_ids]
+    frame_idx = np.minimum(frame_idx, len(f0) - 1)
+    midi = librosa.hz_to_midi(np.maximum(f0[frame_idx], 1e-6))
+    is_voiced = voiced[frame_idx]
+
+    voiced_counts = np.bincount(segment_ids, weights=is_voiced, minlength=n_segments).astype(int)
+    voiced_fraction = voiced_counts / lengths
+
+    # moras with no voiced frames use all of their frames instead.
+    use = is_voiced | (voiced_counts == 0)[segment_ids]
+    counts = np.bincount(segment_ids, weights=use, minlength=n_segments).astype(int)
+
+    # sort each segment's values, pushing unused frames to the end of their segment.
+    keyed = np.where(use, midi, np.inf)
+    order = np.lexsort((keyed, segment_ids))
+    sorted_values = keyed[order]
+
+    low = segment_starts + (counts - 1) // 2
+    high = segment_starts + counts // 2
+    median = (sorted_values[low] + sorted_values[high]) / 2
+
+    cut = np.floor(counts * trim_proportion).astype(int)
+    cut = np.minimum(cut, (counts - 1) // 2)
+    cumulative = np.concatenate(([0], np.cumsum(np.where(np.isfinite(sorted_values), sorted_values, 0))))
+    kept = counts - 2 * cut
+    trimmed_mean = (cumulative[segment_starts + counts - cut] - cumulative[segment_starts + cut]) / kept
+
+    return {"median": median, "trimmed_mean": trimmed_mean, "voiced_fraction": voiced_fraction}
+
 def devoiced_check(word):
     """Check if a word contains a devoiced syllable and if it should be ignored in pitch accent calculations.
     In the future, it might be good if it also takes in the soundclip and checks if it was properly devoiced or not."""
@@ -72,15 +140,20 @@ def error_calculation(expected, actual, tolerance=None):
     else:
         return 1
 
-def grade_pitch_pattern(soundfiles, accent_type, word):
-    """Expects an input of spliced soundfiles that refer to the word.
+def grade_pitch_pattern(soundfiles, accent_type, word, pitches=None):
+    """Expects an input of spliced soundfiles (paths or clip arrays) that refer to the word.
     For instance, gakusei-desu should be spliced ga-ku-se-i-de-su and passed in an array accordingly.
     accent_type refers to one of the four accent pattern types passed as an integer.
-    word should be an array parallel with soundfiles that gives the spliced hiragana string."""
+    word should be an array parallel with soundfiles that gives the spliced hiragana string.
+    If the pitch of each mora is already known (ie. from SpectralFrontEnd.mora_pitches), pass it as pitches
+    and the soundfiles won't be analysed again."""
     grade = 0
-    pitches = []
-    for mora in soundfiles:
-        pitches.append(get_pitch_info(mora))
+    if pitches is None:
+        pitches = []
+        for mora in soundfiles:
+            pitches.append(get_pitch_info(mora))
+    else:
+        pitches = list(pitches)
 
     if accent_type == 0: # heiban
         low_pitch = pitches[0]
@@ -1,15 +1,65 @@
+import json
 import time
-import subprocess
-import io
-import wave
-from base64 import b64decode
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, abort
 from peak_parse import PeakParse
-from grading import calculate_grade
-from utilities import split_word
-import soundfile as sf
+from grading import grade_recording, grade_batch, grade_stream, SyllableSplitError
+from gates import RecordingRejected
+from model_registry import preload_models
+from decoding import data_url_to_bytes, read_upload, decode_audio, DecodeError, UploadTooLargeError
+from worker_pool import GradeWorkerPool, PoolBusyError
+from streaming import StreamRegistry, StreamLimitError, UnknownStreamError
+from jobs import JobQueue, JobQueueFullError, UnknownJobError
+from metrics import start_collecting, stop_collecting, server_timing, prometheus_text
+from front_end import warm_up_front_end
+from lexicon import get_lexicon
+from catalog import get_catalog, UnknownWordError
+from settings import SAMPLING_RATE, SERVER_MODE, STARTUP_MODE, BATCH_MAX_ITEMS, MAX_UPLOAD_BYTES
 
 app = Flask(__name__)
+# flask turns away request bodies declared larger than this with a 413 before anything reads them.
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+
+if SERVER_MODE == "pool":
+    # grades run in worker processes, which load their own whisper models.
+    worker_pool = GradeWorkerPool()
+else:
+    worker_pool = None
+    if STARTUP_MODE == "preload":
+        # load the whisper models, warm up the signal processing and build the lexicon and catalog once per process, before the first grade comes in.
+        preload_models()
+        warm_up_front_end()
+        get_lexicon()
+        get_catalog()
+
+# recordings being streamed in chunk by chunk. these always live in this process (their decoding and rolling
+# analysis do), but the grade they end in goes to the worker pool in "pool" mode.
+streams = StreamRegistry()
+
+@app.before_request
+def start_timings():
+    # every timed stage of the request (ie. decode) is collected so it can be reported back.
+    g.collection, g.timings_token = start_collecting()
+
+@app.after_request
+def add_timings(response):
+    collection = g.get('collection')
+    if collection is not None and collection.timings:
+        response.headers['Server-Timing'] = server_timing(collection.timings)
+    if collection is not None and request.headers.get('X-Debug'):
+        # the full breakdown, with the counted events (ie. a cache hit, or why a split failed), for debugging one request.
+        response.headers['X-Debug-Breakdown'] = json.dumps(collection.debug_summary())
+    return response
+
+@app.teardown_request
+def stop_timings(error=None):
+    if g.get('timings_token') is not None:
+        stop_collecting(g.timings_token)
+
+@app.route('/metrics')
+def get_metrics():
+    """Stage latency histograms and event counters of this process, in the prometheus text format.
+    In "pool" mode these include the grades run on the worker processes."""
+    return app.response_class(prometheus_text(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/time')
 def get_current_time():
@@ -21,30 +71,150 @@ def parse_syllables():
     # file_type = request.form.get("type", "webm")
     # print(audio_file)
     # print(file_type)
-    audio = str(request.json["audio"])
-    audio = audio.split(",")[1]
-    audio = b64decode(audio)
-    # print(audio)
-    # audio = str(request.json["audio"])
-    # audio = b64decode(audio)
-
-    p = subprocess.run(["ffmpeg", "-y", "-i", "-", "-vn", "audio.wav"], input=audio, capture_output=True)
-    if p.returncode != 0:
-        print("ffmpeg:", p.returncode)
-        print(p.stdout)
-        print(p.stderr)
+    try:
+        audio = data_url_to_bytes((request.get_json(silent=True) or {})["audio"])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'audio must be a base64 data url'}), 400
+
+    try:
+        signal = decode_audio(audio)
+    except DecodeError:
         return {"error": "ffmpeg failed to convert audio"}, 500
-    wav_path = "audio.wav"
-    # data, samplerate = sf.read(io.BytesIO(audio))
 
-    gp = PeakParse(wav_path, "せんせいです", 6)
+    gp = PeakParse(signal, "せんせいです", 6)
     syllable_clips = gp.parse_clips()
     # gp.plot_waves()
-    for i, syllable in enumerate(syllable_clips):
-        export_filename = "output/" + "先生" + str(i) + ".wav"
-        sf.write(export_filename, syllable, 22050)
+    # the clips stay in memory. report how long each one is instead of writing them out.
+    return jsonify({'clip_seconds': [len(syllable) / SAMPLING_RATE for syllable in syllable_clips]}), 200
+
+WORD_FILTERS = ['kanji', 'reading', 'accent_type', 'category']
+
+@app.route('/words', methods=['GET'])
+def list_words():
+    """Returns the word catalog (see catalog.py), or with any of kanji, reading, accent_type or category
+    in the query string, {"version": ..., "words": [...]} with just the matching words.
+    Always revalidated against its ETag, so an unchanged catalog costs a 304."""
+    catalog = get_catalog()
+    filters = {key: request.args[key] for key in WORD_FILTERS if key in request.args}
+
+    if filters:
+        response = jsonify({'version': catalog.version, 'words': catalog.find(**filters)})
+        response.add_etag()
+    else:
+        response = app.response_class(catalog.body, mimetype='application/json')
+        response.set_etag(catalog.version)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+@app.route('/words/<version>', methods=['GET'])
+def get_words_version(version):
+    """Returns the word catalog at a version from /words. Its contents never change, so it can be cached forever."""
+    catalog = get_catalog()
+    if version != catalog.version:
+        return jsonify({'error': f'no word catalog with version {version}, the current one is {catalog.version}'}), 404
+
+    response = app.response_class(catalog.body, mimetype='application/json')
+    response.set_etag(catalog.version)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response.make_conditional(request)
+
+def lookup_word(word, accent_type):
+    """Returns the (reading, accent_type) to grade a request's word with. The word can be kanji or its reading,
+    and accent_type can be left out for words in the catalog.
+    Raises ValueError or UnknownWordError if it can't be worked out."""
+    try:
+        accent_type = None if accent_type in (None, '') else int(accent_type)
+    except (TypeError, ValueError):
+        raise ValueError(f'accent_type must be a number, not {accent_type}')
+    return get_catalog().resolve(word, accent_type)
+
+def resolve_word(word, accent_type):
+    """lookup_word for a request grading a single word. Aborts with a 400 if it can't be worked out."""
+    try:
+        return lookup_word(word, accent_type)
+    except (ValueError, UnknownWordError) as e:
+        abort(400, str(e))
+
+@app.errorhandler(400)
+def bad_request(error):
+    return jsonify({'error': error.description}), 400
+
+@app.errorhandler(413)
+def too_large(error):
+    return jsonify({'error': f"requests are limited to {app.config['MAX_CONTENT_LENGTH']} bytes"}), 413
+
+def run_grade(audio, word, accent_type):
+    """Grades one recording, in this thread or on a worker process depending on the SERVER_MODE."""
+    if worker_pool is not None:
+        # memoryviews can't be sent to another process, so this is the one place the upload gets copied.
+        return worker_pool.run(grade_recording, bytes(audio), word, accent_type)
+    return grade_recording(audio, word, accent_type)
+
+def run_stream_grade(signal, stft, pitch_contour, word, accent_type):
+    """Grades a finished stream, in this thread or on a worker process depending on the SERVER_MODE."""
+    if worker_pool is not None:
+        return worker_pool.run(grade_stream, signal, stft, pitch_contour, word, accent_type)
+    return grade_stream(signal, stft, pitch_contour, word, accent_type)
+
+def run_batch(jobs):
+    """Grades a list of (audio, word, accent_type), in this thread or, in "pool" mode, split into one share per worker.
+    Each share still checks its recordings with whisper in batched forward passes (see grade_batch)."""
+    if not jobs:
+        return []
+    if worker_pool is None:
+        return grade_batch(jobs)
+
+    share = -(-len(jobs) // worker_pool.workers)
+    shares = [jobs[start:start + share] for start in range(0, len(jobs), share)]
+    return [result for results in worker_pool.run_each(grade_batch, [(share,) for share in shares]) for result in results]
+
+def describe_grade_error(e):
+    """Returns the error a failed job reports, the same one /grade would have answered with."""
+    if isinstance(e, DecodeError):
+        return {'error': 'ffmpeg failed to convert audio'}
+    if isinstance(e, RecordingRejected):
+        return {'error': str(e), 'gate': e.gate}
+    return {'error': str(e)}
+
+# grades queued through /jobs. these always live in this process.
+job_queue = JobQueue(describe_error=describe_grade_error)
+
+def read_body():
+    """Returns the raw request body as a memoryview. Aborts with a 413 if it is larger than MAX_UPLOAD_BYTES."""
+    try:
+        return read_upload(request.stream, request.content_length)
+    except UploadTooLargeError:
+        abort(413)
+
+def get_upload():
+    """Returns (word, accent_type, audio) from a grade request, with audio as the encoded file's bytes
+    and accent_type None when the client left it out.
+    The audio can arrive three ways:
+    - as the raw request body (ie. Content-Type: audio/webm), with word and accent_type in the query string.
+    - as a file in a multipart form field "sf", next to word and accent_type fields.
+    - as a base64 data url in a form field "sf". kept for older clients.
+    Aborts with a 400 if that data url isn't valid."""
+    if request.mimetype.startswith('audio/') or request.mimetype == 'application/octet-stream':
+        audio = read_body()
+        return request.args.get('word'), request.args.get('accent_type'), audio if len(audio) else None
+
+    word = request.form.get('word')
+    accent_type = request.form.get('accent_type')
+
+    audio_file = request.files.get('sf')
+    if audio_file is not None:
+        try:
+            return word, accent_type, read_upload(audio_file.stream)
+        except UploadTooLargeError:
+            abort(413)
 
-    return jsonify("it works"), 200
+    audio_file = request.form.get('sf')
+    if audio_file:
+        try:
+            return word, accent_type, data_url_to_bytes(audio_file)
+        except ValueError as e:
+            abort(400, str(e))
+    return word, accent_type, None
 
 @app.route('/grade', methods=['POST'])
 def grade():
@@ -52,57 +222,158 @@ def grade():
     # sf = data.get('sf')
     # word = data.get('word')
     # accent_type = data.get('accent_type')
-    word = request.form.get('word')
-    accent_type = request.form.get('accent_type')
-    audio_file = request.form.get('sf')
+    word, accent_type, audio = get_upload()
 
-    if not (word and accent_type and audio_file):
+    if not (word and audio is not None):
         return jsonify({'error': 'Missing required data in request'}), 400
 
-    accent_type = int(accent_type)
-    sf_array = []
-    word_array, mora_length = split_word(word)
-
-    audio = str(audio_file)
-    audio = audio.split(",")[1]
-    audio = b64decode(audio)
-    # print(audio)
-    # audio = str(request.json["audio"])
-    # audio = b64decode(audio)
-
-    p = subprocess.run(["ffmpeg", "-y", "-i", "-", "-vn", "audio.wav"], input=audio, capture_output=True)
-    if p.returncode != 0:
-        print("ffmpeg:", p.returncode)
-        print(p.stdout)
-        print(p.stderr)
+    word, accent_type = resolve_word(word, accent_type)
+
+    try:
+        result = run_grade(audio, word, accent_type)
+    except PoolBusyError as e:
+        return jsonify({'error': str(e)}), 429
+    except DecodeError:
         return {"error": "ffmpeg failed to convert audio"}, 500
-    wav_path = "audio.wav"
-    # data, samplerate = sf.read(io.BytesIO(audio))
+    except RecordingRejected as e:
+        return jsonify({'error': str(e), 'gate': e.gate}), 422
+    except SyllableSplitError as e:
+        return jsonify({"error" : str(e)}), 500
 
-    print("finished converting to wav")
+    return jsonify({'grade': result}), 200
 
-    gp = PeakParse(wav_path, word, mora_length)
-    syllable_clips = gp.parse_clips()
 
-    if len(syllable_clips) == mora_length:
-        for i, syllable in enumerate(syllable_clips):
-            export_filename = "output/" + word[i] + ".wav"
-            # print(export_filename)
-            sf.write(export_filename, syllable, 22050)
-            # sf_array.append(syllable)
-            sf_array.append(export_filename)
-    else:
-        return jsonify({"error" : "incorrect number of syllables detected."}), 500
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Queues a grade and answers right away with the job id to poll at /jobs/<job_id>.
+    Takes the same uploads as /grade. Requests sent again with the same Idempotency-Key header
+    get the job of the first one back instead of grading twice."""
+    word, accent_type, audio = get_upload()
 
-    print("finished splicing audio into mora")
-    # # gp.plot_waves()
-    # for i, syllable in enumerate(syllable_clips):
-    #     export_filename = "output/" + word + str(i) + ".wav"
-    #     sf.write(export_filename, syllable, 22050)
-    #     sf_array.append(syllable)
+    if not (word and audio is not None):
+        return jsonify({'error': 'Missing required data in request'}), 400
 
-    result = calculate_grade(wav_path, sf_array, word, word_array, accent_type)
+    word, accent_type = resolve_word(word, accent_type)
+
+    try:
+        # the upload is copied, since the request's buffer is gone by the time the job runs.
+        job_id = job_queue.submit(run_grade, bytes(audio), word, accent_type, key=request.headers.get('Idempotency-Key'))
+    except JobQueueFullError as e:
+        return jsonify({'error': str(e)}), 429
+
+    response = jsonify(job_queue.get(job_id))
+    response.headers['Location'] = f'/jobs/{job_id}'
+    return response, 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Returns the status of a job, the timings of the stages it has run so far,
+    and once it is done, its grade as "result" (or "error" if it failed)."""
+    try:
+        return jsonify(job_queue.get(job_id)), 200
+    except UnknownJobError as e:
+        return jsonify({'error': str(e)}), 404
+
+
+@app.route('/grade/batch', methods=['POST'])
+def grade_many():
+    """Grades a whole drill set in one request.
+    Expects json of the form {"items": [{"word": ..., "accent_type": ..., "audio": <data url>}, ...]}
+    (accent_type optional, as for /grade) and returns {"results": [...]} with a grade or an error for each item, in order.
+    An item that fails (no audio, an unknown word, a recording turned away by a gate, ...) only fails its own result,
+    as {"error": ...} (plus "gate" if a gate turned it away, like the 422 of /grade)."""
+    items = (request.get_json(silent=True) or {}).get('items')
+
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'Missing required data in request'}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({'error': f'At most {BATCH_MAX_ITEMS} items can be graded per request'}), 413
+
+    # items that can't be graded (no audio, an unknown word, ...) get their error in their own result slot.
+    results = [None] * len(items)
+    jobs = []
+    indexes = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict) or not (item.get('word') and item.get('audio')):
+            results[i] = {'error': 'Missing required data in item'}
+            continue
+        try:
+            word, accent_type = lookup_word(item['word'], item.get('accent_type'))
+        except (ValueError, UnknownWordError) as e:
+            results[i] = {'error': str(e)}
+            continue
+        try:
+            audio = data_url_to_bytes(item['audio'])
+        except ValueError as e:
+            results[i] = {'error': str(e)}
+            continue
+        jobs.append((audio, word, accent_type))
+        indexes.append(i)
+
+    try:
+        graded = run_batch(jobs)
+    except PoolBusyError as e:
+        return jsonify({'error': str(e)}), 429
+
+    for i, result in zip(indexes, graded):
+        results[i] = result
+    return jsonify({'results': results}), 200
+
+
+@app.route('/streams', methods=['POST'])
+def open_stream():
+    """Starts streaming a recording. Returns the stream id the chunks should be sent to."""
+    try:
+        stream_id = streams.open()
+    except StreamLimitError as e:
+        return jsonify({'error': str(e)}), 429
+    return jsonify({'stream_id': stream_id}), 201
+
+@app.route('/streams/<stream_id>/chunks', methods=['POST'])
+def add_stream_chunk(stream_id):
+    """Takes the next chunk of the recording as the raw request body (ie. one MediaRecorder blob).
+    The chunk is decoded and analysed right away."""
+    try:
+        samples = streams.get(stream_id).add_chunk(read_body())
+    except UnknownStreamError as e:
+        return jsonify({'error': str(e)}), 404
+    except DecodeError:
+        streams.pop(stream_id).abort()
+        return {"error": "ffmpeg failed to convert audio"}, 500
+    return jsonify({'samples': samples}), 200
+
+@app.route('/streams/<stream_id>/finish', methods=['POST'])
+def finish_stream(stream_id):
+    """Ends the recording and grades it. Expects the same word and accent_type fields as /grade.
+    In "pool" mode the rest of the analysis and whisper run on a worker process, like any other grade."""
+    word = request.form.get('word')
+
+    if not word:
+        return jsonify({'error': 'Missing required data in request'}), 400
+
+    word, accent_type = resolve_word(word, request.form.get('accent_type'))
+
+    try:
+        signal, stft, pitch_contour = streams.pop(stream_id).finish()
+        result = run_stream_grade(signal, stft, pitch_contour, word, accent_type)
+    except UnknownStreamError as e:
+        return jsonify({'error': str(e)}), 404
+    except PoolBusyError as e:
+        return jsonify({'error': str(e)}), 429
+    except DecodeError:
+        return {"error": "ffmpeg failed to convert audio"}, 500
+    except RecordingRejected as e:
+        return jsonify({'error': str(e), 'gate': e.gate}), 422
+    except SyllableSplitError as e:
+        return jsonify({"error" : str(e)}), 500
 
-    result = round(result, 1)
+    return jsonify({'grade': result}), 200
 
-    return jsonify({'grade': result}), 200
\ No newline at end of file
+@app.route('/streams/<stream_id>', methods=['DELETE'])
+def cancel_stream(stream_id):
+    """Throws away a recording that won't be graded."""
+    try:
+        streams.pop(stream_id).abort()
+    except UnknownStreamError as e:
+        return jsonify({'error': str(e)}), 404
+    return '', 204
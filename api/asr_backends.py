@@ -0,0 +1,86 @@
+import os
+from settings import ASR_BACKEND, ASR_COMPUTE_TYPE, SELECTED_MODEL, MODEL_POOL_SIZE
+from metrics import timed
+
+"""
+Speech recognition backends behind preliminary_pronunciation_check.
+A backend knows how to load and warm up its models, and how to turn a batch of 16 kHz audios and their
+expected texts into coefficients. ASR_BACKEND picks one:
+    "whisper"           openai-whisper in fp32 on torch. supports every WHISPER_INPUT and PRONUNCIATION_SCORING mode.
+    "faster_whisper"    the same whisper weights converted for CTranslate2 and quantized to ASR_COMPUTE_TYPE (int8),
+                        which runs several times faster on cpu in a fraction of the memory, without torch.
+                        pip install faster-whisper
+"""
+
+class WhisperBackend():
+    """openai-whisper, the original backend."""
+    name = "whisper"
+
+    def load(self, model_name):
+        import whisper # local import keeps torch out of processes that never run whisper.
+        return whisper.load_model(model_name)
+
+    def warm_up(self, model):
+        """Runs a language detection and decode over one second of silence.
+        The first inference on a fresh model is much slower than the rest (lazy kernel selection, allocator growth)."""
+        import whisper
+        import numpy as np
+
+        audio = whisper.pad_or_trim(np.zeros(whisper.audio.SAMPLE_RATE, dtype=np.float32))
+        mel = whisper.log_mel_spectrogram(audio, n_mels=model.dims.n_mels).to(model.device)
+        model.detect_language(mel)
+        # the same precision transcribe decodes in, so the path that gets warmed up is the one grading uses.
+        whisper.decode(model, mel, whisper.DecodingOptions(fp16=(model.device.type == "cuda")))
+
+    def check(self, model, audios, expected_texts):
+        from preprocessing import check_audios
+        return check_audios(model, audios, expected_texts)
+
+
+class FasterWhisperBackend():
+    """faster-whisper: whisper on CTranslate2, int8 quantized on cpu."""
+    name = "faster_whisper"
+
+    def load(self, model_name):
+        from faster_whisper import WhisperModel
+        # every pooled instance can run at once, so they split the cores between them.
+        threads = max(1, (os.cpu_count() or 1) // MODEL_POOL_SIZE)
+        return WhisperModel(model_name, device="cpu", compute_type=ASR_COMPUTE_TYPE, cpu_threads=threads)
+
+    def warm_up(self, model):
+        import numpy as np
+        self.transcribe(model, np.zeros(16000, dtype=np.float32))
+
+    def transcribe(self, model, audio):
+        """Returns (language, text), decoded greedily like whisper.DecodingOptions() does."""
+        # encoding and decoding both happen inside CTranslate2, so they are timed as one stage.
+        with timed("whisper_transcribe"):
+            segments, info = model.transcribe(audio, beam_size=1, temperature=0, without_timestamps=True,
+                                              condition_on_previous_text=False)
+            # segments is a generator, the decoding only happens as it is consumed.
+            return info.language, "".join(segment.text for segment in segments).strip()
+
+    def check(self, model, audios, expected_texts):
+        from preprocessing import score_transcription
+        # CTranslate2 doesn't expose the decoder logits forced scoring needs, so this backend always transcribes.
+        coefficients = []
+        for audio, expected_text in zip(audios, expected_texts):
+            detected_language, text = self.transcribe(model, audio)
+            print(f"Detected language: {detected_language}")
+            print(text)
+            coefficients.append(score_transcription(detected_language, text, expected_text))
+        return coefficients
+
+
+BACKENDS = {backend.name: backend for backend in (WhisperBackend(), FasterWhisperBackend())}
+
+def get_backend(name=None):
+    """Returns the backend with the given name, or the configured ASR_BACKEND."""
+    return BACKENDS[name or ASR_BACKEND]
+
+def check_with_backend(audios, expected_texts, backend=None, model_name=SELECTED_MODEL):
+    """Checks out a model of the backend from the process-wide pool and returns the coefficient of each audio."""
+    from model_registry import get_pool
+    backend = get_backend(backend)
+    with get_pool(model_name, backend=backend.name).checkout() as model:
+        return backend.check(model, audios, expected_texts)
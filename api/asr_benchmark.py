@@ -0,0 +1,122 @@
+import os
+import sys
+import time
+import resource
+import argparse
+import multiprocessing
+
+from settings import SELECTED_MODEL, REFERENCE_AUDIO_DIRECTORIES
+
+"""
+Compares the speech recognition backends (see asr_backends) on the recordings we ship.
+Each backend runs in its own process, so its memory use can be measured on its own, and reports:
+    load time, warm up included
+    latency of the pronunciation check on each recording
+    peak resident memory of the process
+    the coefficient of each recording, to check the backends agree
+and exits with an error if any backend's coefficient is further than --tolerance from the first backend's on any
+recording, or if they disagree on whether a recording is ruled out (a coefficient of 0).
+Run from the api folder:
+    python asr_benchmark.py
+    python asr_benchmark.py --backends whisper faster_whisper --limit 10 --tolerance 0.05
+"""
+
+PARITY_TOLERANCE = 0.1 # largest coefficient difference from the first backend that still counts as agreeing
+
+# the single mora recordings in api/samples, which aren't words in the lexicon.
+SAMPLE_READINGS = {"de": "で", "ga": "が", "ku": "く", "sei": "せい", "su": "す"}
+
+def recordings(limit=None):
+    """Returns (path, reading) for every reference recording we know the reading of."""
+    from reference_index import known_readings
+    readings = known_readings()
+    readings.setdefault("学生", ("がくせいです", None))
+    for name, reading in SAMPLE_READINGS.items():
+        readings.setdefault(name, (reading, None))
+
+    found = []
+    for directory in REFERENCE_AUDIO_DIRECTORIES:
+        for name in sorted(os.listdir(directory)):
+            kanji, extension = os.path.splitext(name)
+            if extension == ".wav" and kanji in readings:
+                found.append((os.path.join(directory, name), readings[kanji][0]))
+    return found[:limit]
+
+def run_backend(backend_name, model_name, items, results):
+    """Runs in a fresh process. Puts a dict of measurements on the results queue."""
+    from asr_backends import get_backend
+    from preprocessing import load_whisper_audio
+
+    backend = get_backend(backend_name)
+    audios = [load_whisper_audio(path) for path, _ in items]
+
+    start = time.perf_counter()
+    model = backend.load(model_name)
+    backend.warm_up(model)
+    load_seconds = time.perf_counter() - start
+
+    latencies, coefficients = [], []
+    for audio, (_, reading) in zip(audios, items):
+        start = time.perf_counter()
+        coefficients.append(backend.check(model, [audio], [reading])[0])
+        latencies.append(time.perf_counter() - start)
+
+    # ru_maxrss is in kilobytes on linux, bytes on macos
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024 * 1024) if sys.platform == "darwin" else peak_rss / 1024
+
+    results.put({"backend": backend_name, "load_seconds": load_seconds, "latencies": latencies,
+                 "coefficients": coefficients, "peak_rss_mb": peak_rss_mb})
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+def main():
+    parser = argparse.ArgumentParser(description="compare the speech recognition backends on the shipped recordings")
+    parser.add_argument("--backends", nargs="+", default=["whisper", "faster_whisper"])
+    parser.add_argument("--model", default=SELECTED_MODEL)
+    parser.add_argument("--limit", type=int, default=None, help="only use the first LIMIT recordings")
+    parser.add_argument("--tolerance", type=float, default=PARITY_TOLERANCE,
+                        help="largest coefficient difference from the first backend before the run fails")
+    args = parser.parse_args()
+
+    items = recordings(args.limit)
+    context = multiprocessing.get_context("spawn")
+    reports = []
+    for backend_name in args.backends:
+        results = context.Queue()
+        process = context.Process(target=run_backend, args=(backend_name, args.model, items, results))
+        process.start()
+        report = results.get()
+        process.join()
+        reports.append(report)
+
+    print(f"{len(items)} recordings, model '{args.model}'")
+    print(f"{'backend':<16}{'load s':>10}{'median s':>10}{'total s':>10}{'peak rss mb':>14}")
+    for report in reports:
+        print(f"{report['backend']:<16}{report['load_seconds']:>10.2f}{median(report['latencies']):>10.3f}"
+              f"{sum(report['latencies']):>10.2f}{report['peak_rss_mb']:>14.0f}")
+
+    # parity: every backend against the first one
+    baseline = reports[0]
+    failed = False
+    for report in reports[1:]:
+        differences = [abs(a - b) for a, b in zip(baseline["coefficients"], report["coefficients"])]
+        agree = sum(difference < 1e-6 for difference in differences)
+        print(f"{report['backend']} vs {baseline['backend']}: same coefficient on {agree}/{len(items)} recordings, "
+              f"mean difference {sum(differences) / len(differences):.3f}, max difference {max(differences):.3f}")
+        for (path, reading), a, b in zip(items, baseline["coefficients"], report["coefficients"]):
+            if abs(a - b) >= 1e-6:
+                disagrees = abs(a - b) > args.tolerance or (a == 0) != (b == 0)
+                failed = failed or disagrees
+                print(f"    {os.path.basename(path)} ({reading}): {a:.3f} vs {b:.3f}{'  FAIL' if disagrees else ''}")
+
+    if failed:
+        print(f"backends disagree by more than {args.tolerance}.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import statistics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import librosa
+from settings import SAMPLING_RATE, REFERENCE_AUDIO_DIRECTORIES
+
+"""
+Benchmarks the grader on the recordings we ship (the REFERENCE_AUDIO_DIRECTORIES: the 1+2 Noun recordings and api/samples).
+Reports, and writes as json:
+    wall time of the full grade of each recording, broken down by stage (see metrics.py)
+    wall time of PeakParse, DurationParse, get_pitch_info and the whisper check run on their own
+    throughput of the full grade with N worker processes
+    peak resident memory of the benchmark and of its workers
+    accuracy: how many recordings split into the right number of mora, how many got graded, and the grades
+and compares them against a stored baseline, failing (exit code 1) if anything got slower, heavier or less accurate
+than the tolerances allow, or if there is no baseline to compare against (unless --update-baseline records one).
+Timings only compare meaningfully on the machine the baseline was recorded on, so no baseline is shipped.
+Run from the api folder:
+    python benchmark.py --update-baseline            # record the baseline, ie. on main
+    python benchmark.py                              # after a change: compare against it
+    python benchmark.py --workers 1 2 4 --no-asr     # signal processing only, ie. without whisper installed
+"""
+
+BASELINE_FILE = "benchmark_baseline.json"
+RESULTS_FILE = "benchmark_results.json"
+TIME_TOLERANCE = 0.25 # a stage may get this much slower (relative to the baseline median) before it counts as a regression
+RATE_TOLERANCE = 0.02 # split and graded rates may drop by this much (absolute)
+GRADE_TOLERANCE = 2.0 # the mean grade may move by this many points
+
+def corpus(limit=None):
+    """Returns (name, path, reading, accent_type) for every shipped recording of a word we know the reading and accent type of."""
+    from reference_index import known_readings
+    readings = known_readings()
+    readings.setdefault("学生", ("がくせいです", 0))
+
+    found = []
+    for directory in REFERENCE_AUDIO_DIRECTORIES:
+        for name in sorted(os.listdir(directory)):
+            kanji, extension = os.path.splitext(name)
+            if extension == ".wav" and kanji in readings and readings[kanji][1] is not None:
+                found.append((kanji, os.path.join(directory, name), *readings[kanji]))
+    return found[:limit]
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on linux, bytes on macos
+    peak_rss = resource.getrusage(who).ru_maxrss
+    return peak_rss / (1024 * 1024) if sys.platform == "darwin" else peak_rss / 1024
+
+def summarize(seconds):
+    """Returns the count, total, mean, median, p95 and max of a list of durations."""
+    if not seconds:
+        return {"count": 0}
+    ordered = sorted(seconds)
+    return {
+        "count": len(ordered),
+        "total": sum(ordered),
+        "mean": statistics.fmean(ordered),
+        "median": statistics.median(ordered),
+        "p95": ordered[min(int(round(0.95 * (len(ordered) - 1))), len(ordered) - 1)],
+        "max": ordered[-1],
+    }
+
+def warm_up(asr, workers=1):
+    """Loads everything a grade needs, so the first recording isn't timed with it."""
+    from front_end import warm_up_front_end
+    from lexicon import get_lexicon
+    warm_up_front_end()
+    get_lexicon()
+    if asr:
+        from model_registry import preload_models, limit_torch_threads
+        preload_models(size=1)
+        limit_torch_threads(workers)
+
+def grade_one(item, asr=True):
+    """Runs the full grade of one recording, from loading the file.
+    Without asr the whisper check is skipped and the coefficient taken as 1, so only the signal processing is measured.
+    Returns {"name", "seconds", "timings": {stage: seconds}} and either "grade" or "failure"."""
+    from metrics import collect, timed
+    from grading import grade_signal, split_front_end, calculate_grade, SyllableSplitError
+    from gates import check_recording, RecordingRejected
+    from front_end import SpectralFrontEnd
+    from utilities import split_word
+
+    name, path, reading, accent_type = item
+    outcome = {"name": name}
+    with collect() as collection:
+        start = time.perf_counter()
+        with timed("load"):
+            signal, _ = librosa.load(path, sr=SAMPLING_RATE)
+        try:
+            if asr:
+                grade = grade_signal(signal, reading, accent_type)[0]
+            else:
+                word_array, mora_length = split_word(reading)
+                check_recording(signal, mora_length)
+                signal, clips, pitches, region = split_front_end(SpectralFrontEnd(signal), reading, accent_type)
+                grade = round(calculate_grade(signal, clips, reading, word_array, accent_type,
+                                              pitches=pitches, coefficient=1, region=region), 1)
+            outcome["grade"] = grade
+        except RecordingRejected as e:
+            outcome["failure"] = f"gate:{e.gate}"
+        except SyllableSplitError as e:
+            outcome["failure"] = f"split:{e}"
+        outcome["seconds"] = time.perf_counter() - start
+    outcome["timings"] = dict(collection.timings)
+    return outcome
+
+def run_grades(items, asr):
+    """Grades every recording in this process. Returns (outcomes, report)."""
+    outcomes = [grade_one(item, asr) for item in items]
+
+    breakdown = {}
+    for outcome in outcomes:
+        for stage, seconds in outcome["timings"].items():
+            breakdown.setdefault(stage, []).append(seconds)
+    report = {
+        "wall": summarize([outcome["seconds"] for outcome in outcomes]),
+        "breakdown": {stage: summarize(seconds) for stage, seconds in sorted(breakdown.items())},
+    }
+    return outcomes, report
+
+def run_stages(items, asr):
+    """Times PeakParse, DurationParse, get_pitch_info (on each PeakParse clip) and the whisper check on their own.
+    Returns (stage summaries, PeakParse split success rate)."""
+    from peak_parse import PeakParse
+    from duration_parse import DurationParse
+    from analysis import get_pitch_info
+    from preprocessing import preliminary_pronunciation_check
+    from utilities import split_word
+
+    seconds = {"peak_parse": [], "duration_parse": [], "get_pitch_info": [], "preliminary_check": []}
+    splits = 0
+    for name, path, reading, _ in items:
+        signal, _ = librosa.load(path, sr=SAMPLING_RATE)
+        _, mora_length = split_word(reading)
+
+        start = time.perf_counter()
+        try:
+            clips = PeakParse(signal, reading, mora_length).parse_clips()
+        except (IndexError, ValueError):
+            clips = []
+        seconds["peak_parse"].append(time.perf_counter() - start)
+        splits += len(clips) == mora_length
+
+        start = time.perf_counter()
+        DurationParse(name, mora_length, signal).get_divisions()
+        seconds["duration_parse"].append(time.perf_counter() - start)
+
+        for clip in clips:
+            start = time.perf_counter()
+            get_pitch_info(clip)
+            seconds["get_pitch_info"].append(time.perf_counter() - start)
+
+        if asr:
+            start = time.perf_counter()
+            preliminary_pronunciation_check(signal, reading)
+            seconds["preliminary_check"].append(time.perf_counter() - start)
+
+    return {stage: summarize(values) for stage, values in seconds.items() if values}, splits / max(len(items), 1)
+
+def run_throughput(items, workers, asr):
+    """Grades every recording over a pool of worker processes. Returns {"workers", "seconds", "recordings_per_second"}."""
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=warm_up, initargs=(asr, workers)) as executor:
+        # start (and warm up) every worker before the clock starts.
+        list(executor.map(time.sleep, [0.5] * workers))
+        start = time.perf_counter()
+        list(executor.map(grade_one, items, [asr] * len(items)))
+        elapsed = time.perf_counter() - start
+    return {"workers": workers, "seconds": elapsed, "recordings_per_second": len(items) / elapsed}
+
+def accuracy(outcomes, split_success_rate):
+    """Summarizes the split success rate of PeakParse, and the outcome and grades of the full grades."""
+    grades = [outcome["grade"] for outcome in outcomes if "grade" in outcome]
+    failures = {}
+    for outcome in outcomes:
+        if "failure" in outcome:
+            failures[outcome["failure"]] = failures.get(outcome["failure"], 0) + 1
+
+    histogram = {f"{low}-{low + 10}": 0 for low in range(0, 100, 10)}
+    for grade in grades:
+        low = min(int(grade // 10) * 10, 90)
+        histogram[f"{low}-{low + 10}"] += 1
+
+    return {
+        "split_success_rate": split_success_rate,
+        "graded_rate": len(grades) / max(len(outcomes), 1),
+        "failures": failures,
+        "grades": {
+            "mean": statistics.fmean(grades) if grades else None,
+            "median": statistics.median(grades) if grades else None,
+            "min": min(grades, default=None),
+            "max": max(grades, default=None),
+            "histogram": histogram,
+        },
+        "per_recording": {outcome["name"]: outcome.get("grade") for outcome in outcomes},
+    }
+
+def compare(results, baseline, time_tolerance=TIME_TOLERANCE):
+    """Returns a message for every way results regressed from the baseline."""
+    regressions = []
+
+    def slower(label, current, previous):
+        if current and previous and current.get("count") and previous.get("count") \
+                and current["median"] > previous["median"] * (1 + time_tolerance):
+            regressions.append(f"{label}: median {current['median'] * 1000:.1f} ms, baseline {previous['median'] * 1000:.1f} ms")
+
+    slower("grade", results["grade"]["wall"], baseline["grade"]["wall"])
+    for stage, previous in baseline["grade"]["breakdown"].items():
+        slower(f"grade stage {stage}", results["grade"]["breakdown"].get(stage), previous)
+    for stage, previous in baseline["stages"].items():
+        slower(stage, results["stages"].get(stage), previous)
+
+    previous_throughput = {run["workers"]: run for run in baseline["throughput"]}
+    for run in results["throughput"]:
+        previous = previous_throughput.get(run["workers"])
+        if previous and run["recordings_per_second"] < previous["recordings_per_second"] * (1 - time_tolerance):
+            regressions.append(f"throughput at {run['workers']} workers: {run['recordings_per_second']:.2f}/s, "
+                               f"baseline {previous['recordings_per_second']:.2f}/s")
+
+    for who, current in results["peak_rss_mb"].items():
+        previous = baseline["peak_rss_mb"].get(who)
+        if previous and current > previous * (1 + time_tolerance):
+            regressions.append(f"peak rss of the {who}: {current:.0f} mb, baseline {previous:.0f} mb")
+
+    for rate in ("split_success_rate", "graded_rate"):
+        current, previous = results["accuracy"][rate], baseline["accuracy"][rate]
+        if current < previous - RATE_TOLERANCE:
+            regressions.append(f"{rate}: {current:.1%}, baseline {previous:.1%}")
+
+    current, previous = results["accuracy"]["grades"]["mean"], baseline["accuracy"]["grades"]["mean"]
+    if current is not None and previous is not None and abs(current - previous) > GRADE_TOLERANCE:
+        regressions.append(f"mean grade: {current:.1f}, baseline {previous:.1f}")
+    return regressions
+
+def print_report(results):
+    print(f"{results['config']['recordings']} recordings, whisper {'on' if results['config']['asr'] else 'off'}")
+    print(f"{'stage':<28}{'count':>7}{'median ms':>12}{'p95 ms':>10}{'total s':>10}")
+    rows = [("grade", results["grade"]["wall"])]
+    rows += [(f"  {stage}", summary) for stage, summary in results["grade"]["breakdown"].items()]
+    rows += list(results["stages"].items())
+    for label, summary in rows:
+        print(f"{label:<28}{summary['count']:>7}{summary['median'] * 1000:>12.1f}{summary['p95'] * 1000:>10.1f}{summary['total']:>10.2f}")
+    for run in results["throughput"]:
+        print(f"{run['workers']} workers: {run['recordings_per_second']:.2f} recordings/s")
+    print(f"peak rss: {results['peak_rss_mb']['benchmark']:.0f} mb (benchmark), {results['peak_rss_mb']['workers']:.0f} mb (largest worker)")
+    found = results["accuracy"]
+    print(f"split success {found['split_success_rate']:.1%}, graded {found['graded_rate']:.1%}, "
+          f"mean grade {found['grades']['mean'] if found['grades']['mean'] is None else round(found['grades']['mean'], 1)}")
+    for failure, amount in sorted(found["failures"].items()):
+        print(f"    {amount} x {failure}")
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the grader on the shipped recordings")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="worker counts to measure throughput at")
+    parser.add_argument("--limit", type=int, default=None, help="only use the first LIMIT recordings")
+    parser.add_argument("--no-asr", action="store_true", help="skip whisper and only measure the signal processing")
+    parser.add_argument("--output", default=RESULTS_FILE, help="where to write the results as json")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline to compare against")
+    parser.add_argument("--update-baseline", action="store_true", help="store these results as the new baseline instead of comparing")
+    parser.add_argument("--tolerance", type=float, default=TIME_TOLERANCE, help="allowed slowdown, ie. 0.25 for 25%%")
+    args = parser.parse_args()
+    asr = not args.no_asr
+
+    from result_cache import settings_fingerprint
+    items = corpus(args.limit)
+    warm_up(asr)
+
+    outcomes, grade_report = run_grades(items, asr)
+    stages, split_success_rate = run_stages(items, asr)
+    throughput = [run_throughput(items, workers, asr) for workers in args.workers]
+
+    results = {
+        "config": {"recordings": len(items), "asr": asr, "workers": args.workers, "settings": settings_fingerprint()},
+        "grade": grade_report,
+        "stages": stages,
+        "throughput": throughput,
+        "peak_rss_mb": {"benchmark": peak_rss_mb(), "workers": peak_rss_mb(resource.RUSAGE_CHILDREN)},
+        "accuracy": accuracy(outcomes, split_success_rate),
+    }
+    print_report(results)
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(results, file, ensure_ascii=False, indent=2)
+    print(f"wrote {args.output}")
+
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+        print(f"stored as the baseline in {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        # a missing baseline fails the run, so a regression gate that was never set up can't pass silently.
+        print(f"no baseline at {args.baseline}. record one with --update-baseline.")
+        sys.exit(1)
+
+    with open(args.baseline, encoding="utf-8") as file:
+        baseline = json.load(file)
+    if baseline["config"]["asr"] != asr or baseline["config"]["recordings"] != len(items):
+        print("the baseline was recorded with different options (whisper on/off or recordings), not comparing.")
+        sys.exit(1)
+    if baseline["config"]["settings"] != results["config"]["settings"]:
+        print("note: settings.py changed since the baseline, so accuracy differences may be intended.")
+
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+    print("no regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import json
+import hashlib
+import threading
+from lexicon import get_lexicon
+
+"""
+The word catalog served to the frontend.
+Every word list is compiled, once per process, into a single JSON document that carries its own indexes
+(by kanji, reading, accent type and category), so clients never parse the word list text files themselves.
+The document is versioned by a hash of its contents: the version doubles as the ETag, and
+/words/<version> can be cached forever because its contents can never change.
+"""
+
+FIELDS = ["kanji", "reading", "romaji", "mora", "mora_length", "accent_type", "contour", "english", "category"]
+
+class UnknownWordError(Exception):
+    """Raised when a word isn't in the catalog and the request doesn't say how to grade it."""
+    pass
+
+
+class Catalog():
+    """
+    Compiled word catalog. body is the serialized document, version its content hash.
+    """
+    def __init__(self, lexicon):
+        self._lexicon = lexicon
+        self._words = sorted(({field: entry[field] for field in FIELDS} for entry in lexicon),
+                             key=lambda word: (word["category"] or "", word["reading"], word["kanji"]))
+
+        index = {"kanji": {}, "reading": {}, "accent_type": {}, "category": {}}
+        for i, word in enumerate(self._words):
+            index["kanji"][word["kanji"]] = i
+            for field in ("reading", "accent_type", "category"):
+                if word[field] is not None:
+                    index[field].setdefault(str(word[field]), []).append(i)
+        self._index = index
+
+        words = json.dumps(self._words, ensure_ascii=False, sort_keys=True)
+        self.version = hashlib.sha256(words.encode("utf-8")).hexdigest()[:16]
+        self.body = json.dumps({"version": self.version, "words": self._words, "index": index},
+                               ensure_ascii=False, sort_keys=True).encode("utf-8")
+
+    def find(self, kanji=None, reading=None, accent_type=None, category=None):
+        """Returns every word matching all of the given fields."""
+        matches = range(len(self._words))
+        if kanji is not None:
+            matches = [self._index["kanji"][kanji]] if kanji in self._index["kanji"] else []
+        for field, value in (("reading", reading), ("accent_type", accent_type), ("category", category)):
+            if value is not None:
+                allowed = set(self._index[field].get(str(value), []))
+                matches = [i for i in matches if i in allowed]
+        return [self._words[i] for i in matches]
+
+    def resolve(self, word, accent_type=None):
+        """Given the word a grade request names (kanji or reading) and the accent_type it passed, if any,
+        returns the (reading, accent_type) to grade it with. Words in the catalog fill in whatever wasn't passed.
+        Raises UnknownWordError if the word isn't in the catalog and no accent_type was passed, or if it is a reading
+        shared by words with different (or unknown) accent types (ie. にほんです, 日本 or 二本) and no accent_type was passed."""
+        candidates = self._lexicon.matches(word, accent_type)
+        if accent_type is None and len({entry["accent_type"] for entry in candidates}) > 1:
+            raise UnknownWordError(f"ambiguous reading {word}, pass accent_type or kanji.")
+        entry = candidates[0] if candidates else None
+        if entry is None or (accent_type is None and entry["accent_type"] is None):
+            if accent_type is None:
+                raise UnknownWordError(f"unknown word {word}, pass its accent_type.")
+            return word, accent_type
+        return entry["reading"], entry["accent_type"] if accent_type is None else accent_type
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+def get_catalog():
+    """Returns the process-wide catalog, compiling it on first use."""
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = Catalog(get_lexicon())
+    return _catalog
@@ -0,0 +1,321 @@
+import io
+import queue
+import subprocess
+import threading
+import binascii
+from binascii import a2b_base64
+
+import numpy as np
+from settings import SAMPLING_RATE, DECODER, FFMPEG_POOL_SIZE, MAX_UPLOAD_BYTES
+from metrics import timed, count
+
+"""
+Decodes uploaded recordings straight into memory.
+ffmpeg writes raw mono float32 samples to a pipe instead of a wav file, so a grade never
+touches the filesystem and concurrent requests can't overwrite each other's audio.
+If PyAV is installed the decode runs in process, otherwise it uses a pool of ffmpeg processes
+that were started ahead of time.
+Uploads that arrive in pieces can be decoded as they arrive with open_streaming_decoder.
+"""
+
+class DecodeError(Exception):
+    """Raised when ffmpeg fails to convert the uploaded audio."""
+    pass
+
+class UploadTooLargeError(Exception):
+    """Raised when an upload is larger than MAX_UPLOAD_BYTES."""
+    pass
+
+def data_url_to_bytes(data_url):
+    """Given a base64 data url (ie. "data:audio/webm;base64,...."), returns the encoded file as bytes.
+    Raises ValueError if it isn't a base64 data url."""
+    with timed("base64"):
+        audio = str(data_url)
+        comma = audio.find(",")
+        if comma < 0:
+            raise ValueError("audio must be a base64 data url")
+        try:
+            return a2b_base64(audio[comma + 1:])
+        except binascii.Error as e:
+            raise ValueError("audio must be a base64 data url") from e
+
+def read_upload(stream, length=None, limit=MAX_UPLOAD_BYTES):
+    """Given the stream of a binary upload (a request body or a multipart file), returns its bytes as a memoryview.
+    In-memory streams are handed back without copying, anything else is read into a buffer that grows as the bytes
+    arrive (never trusting the length the client claims). Reads stop at length, if given.
+    Raises UploadTooLargeError once the upload is larger than limit."""
+    if hasattr(stream, "getbuffer"):
+        view = stream.getbuffer()
+        if len(view) > limit:
+            raise UploadTooLargeError(f"uploads are limited to {limit} bytes.")
+        return view
+
+    buffer = bytearray()
+    while length is None or len(buffer) < length:
+        wanted = 65536 if length is None else min(65536, length - len(buffer))
+        chunk = stream.read(wanted)
+        if not chunk:
+            break
+        buffer += chunk
+        if len(buffer) > limit:
+            raise UploadTooLargeError(f"uploads are limited to {limit} bytes.")
+    return memoryview(buffer)
+
+def decode_audio(audio, sampling_rate=SAMPLING_RATE):
+    """Given the bytes (or a memoryview of them) of an encoded audio file (webm, wav, ...), returns a 1D float32 signal.
+    The signal is mono and resampled to sampling_rate, the same thing librosa.load(file) returns.
+    The time taken is recorded under the "decode" stage."""
+    with timed("decode"):
+        try:
+            if _use_pyav():
+                return _decode_in_process(audio, sampling_rate)
+            return _get_ffmpeg_pool(sampling_rate).decode(audio)
+        except DecodeError:
+            count("decode_failures")
+            raise
+
+def _ffmpeg_command(sampling_rate, *options):
+    return ["ffmpeg", "-loglevel", "error", "-i", "-", "-vn", "-ac", "1", "-ar", str(sampling_rate), "-f", "f32le", *options, "-"]
+
+def _use_pyav():
+    global _pyav_available
+    if DECODER == "ffmpeg":
+        return False
+    if _pyav_available is None:
+        try:
+            import av
+            _pyav_available = True
+        except ImportError:
+            if DECODER == "pyav":
+                raise
+            _pyav_available = False
+    return _pyav_available
+
+def _resampled_samples(container, sampling_rate):
+    """Yields the first audio stream of a PyAV container as mono float32 arrays at sampling_rate."""
+    import av
+
+    resampler = av.AudioResampler(format="flt", layout="mono", rate=sampling_rate)
+    for frame in container.decode(audio=0):
+        for resampled in resampler.resample(frame):
+            yield resampled.to_ndarray().reshape(-1)
+    # flush whatever the resampler is still holding on to
+    for resampled in resampler.resample(None):
+        yield resampled.to_ndarray().reshape(-1)
+
+def _decode_in_process(audio, sampling_rate):
+    """Decodes with PyAV (libav* bindings) inside this process, so no ffmpeg process is spawned at all."""
+    import av
+
+    try:
+        with av.open(io.BytesIO(audio)) as container:
+            pieces = list(_resampled_samples(container, sampling_rate))
+    except (av.error.FFmpegError, ValueError) as e:
+        print("pyav:", e)
+        raise DecodeError("ffmpeg failed to convert audio")
+
+    if not pieces:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(pieces)
+
+
+class FfmpegPool():
+    """
+    Keeps `size` ffmpeg processes started and waiting on their stdin.
+    A decode takes one that is already running, so the process spawn and startup happen ahead of time,
+    off the request's critical path. A replacement is started in the background right away.
+    """
+    def __init__(self, size, sampling_rate=SAMPLING_RATE):
+        self._command = _ffmpeg_command(sampling_rate)
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._spawn()
+
+    def _start(self):
+        return subprocess.Popen(self._command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def _spawn(self):
+        self._idle.put(self._start())
+
+    def decode(self, audio):
+        try:
+            process = self._idle.get_nowait()
+            threading.Thread(target=self._spawn, daemon=True).start()
+        except queue.Empty:
+            # every warm process is taken. start one for this decode without adding to the pool.
+            process = self._start()
+
+        stdout, stderr = process.communicate(audio)
+        if process.returncode != 0:
+            print("ffmpeg:", process.returncode)
+            print(stderr)
+            raise DecodeError("ffmpeg failed to convert audio")
+
+        return np.frombuffer(stdout, dtype=np.float32)
+
+
+_pyav_available = None
+_ffmpeg_pools = {}
+_ffmpeg_pools_lock = threading.Lock()
+
+def _get_ffmpeg_pool(sampling_rate):
+    with _ffmpeg_pools_lock:
+        pool = _ffmpeg_pools.get(sampling_rate)
+        if pool is None:
+            pool = FfmpegPool(FFMPEG_POOL_SIZE, sampling_rate)
+            _ffmpeg_pools[sampling_rate] = pool
+    return pool
+
+def open_streaming_decoder(sampling_rate=SAMPLING_RATE):
+    """Returns a decoder for an upload that arrives in pieces, using PyAV or ffmpeg the same way decode_audio would.
+    Both kinds have feed(chunk), take(), close() and abort()."""
+    if _use_pyav():
+        return PyavStreamingDecoder(sampling_rate)
+    return StreamingDecoder(sampling_rate)
+
+class StreamingDecoder():
+    """
+    Decodes an upload that arrives in pieces (ie. MediaRecorder chunks) while it is still arriving, with ffmpeg.
+    One ffmpeg process lives for the whole stream. Chunks are written to its stdin as they come in,
+    and a reader thread collects the decoded samples from its stdout.
+    """
+    def __init__(self, sampling_rate=SAMPLING_RATE):
+        self._process = subprocess.Popen(_ffmpeg_command(sampling_rate, "-flush_packets", "1"),
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read_output, daemon=True)
+        self._reader.start()
+
+    def _read_output(self):
+        while True:
+            data = self._process.stdout.read1(65536)
+            if not data:
+                break
+            with self._lock:
+                self._buffer += data
+
+    def feed(self, chunk):
+        """Sends the next piece of the encoded file to the decoder."""
+        try:
+            self._process.stdin.write(chunk)
+            self._process.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            raise DecodeError("ffmpeg failed to convert audio")
+
+    def take(self):
+        """Returns the samples decoded since the last call to take, as a float32 array."""
+        with self._lock:
+            end = len(self._buffer) - len(self._buffer) % 4
+            samples = np.frombuffer(bytes(self._buffer[:end]), dtype=np.float32)
+            del self._buffer[:end]
+        return samples
+
+    def close(self):
+        """Tells the decoder no more chunks are coming and waits for it to finish.
+        Returns the samples decoded since the last call to take."""
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self._reader.join()
+        stderr = self._process.stderr.read()
+        if self._process.wait() != 0:
+            print("ffmpeg:", self._process.returncode)
+            print(stderr)
+            raise DecodeError("ffmpeg failed to convert audio")
+        return self.take()
+
+    def abort(self):
+        """Stops the decoder without waiting for the rest of the output."""
+        self._process.kill()
+        self._process.wait()
+
+
+class _ChunkPipe():
+    """
+    File-like object PyAV reads a stream from. read blocks until the next chunk arrives,
+    and returns b"" (the end of the file) once the stream is closed and every chunk has been read.
+    """
+    def __init__(self):
+        self._data = bytearray()
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def write(self, chunk):
+        with self._condition:
+            self._data += chunk
+            self._condition.notify()
+
+    def read(self, size=-1):
+        with self._condition:
+            while not self._data and not self._closed:
+                self._condition.wait()
+            if size is None or size < 0:
+                size = len(self._data)
+            data = bytes(self._data[:size])
+            del self._data[:size]
+            return data
+
+    def close(self, discard=False):
+        with self._condition:
+            self._closed = True
+            if discard:
+                self._data.clear()
+            self._condition.notify_all()
+
+class PyavStreamingDecoder():
+    """
+    Decodes an upload that arrives in pieces with PyAV, inside this process.
+    Chunks go into a pipe that a decoder thread reads the container from, so no ffmpeg process is spawned.
+    """
+    def __init__(self, sampling_rate=SAMPLING_RATE):
+        self._sampling_rate = sampling_rate
+        self._pipe = _ChunkPipe()
+        self._pieces = []
+        self._failed = False
+        self._aborted = False
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read_output, daemon=True)
+        self._reader.start()
+
+    def _read_output(self):
+        import av
+
+        try:
+            with av.open(self._pipe) as container:
+                for samples in _resampled_samples(container, self._sampling_rate):
+                    with self._lock:
+                        self._pieces.append(samples)
+        except (av.error.FFmpegError, ValueError) as e:
+            if not self._aborted:
+                print("pyav:", e)
+            self._failed = True
+
+    def feed(self, chunk):
+        """Sends the next piece of the encoded file to the decoder."""
+        if self._failed:
+            raise DecodeError("ffmpeg failed to convert audio")
+        self._pipe.write(chunk)
+
+    def take(self):
+        """Returns the samples decoded since the last call to take, as a float32 array."""
+        with self._lock:
+            pieces, self._pieces = self._pieces, []
+        if not pieces:
+            return np.zeros(0, dtype=np.float32)
+        return np.concatenate(pieces)
+
+    def close(self):
+        """Tells the decoder no more chunks are coming and waits for it to finish.
+        Returns the samples decoded since the last call to take."""
+        self._pipe.close()
+        self._reader.join()
+        if self._failed:
+            raise DecodeError("ffmpeg failed to convert audio")
+        return self.take()
+
+    def abort(self):
+        """Stops the decoder without waiting for the rest of the output."""
+        self._aborted = True
+        self._pipe.close(discard=True)
@@ -0,0 +1,104 @@
+import numpy as np
+from settings import DTW_BAND
+from front_end import SpectralFrontEnd
+from alignment import normalize_contour, banded_dtw, map_boundaries
+from reference_index import get_reference_index
+from lexicon import get_lexicon
+from utilities import split_word
+
+"""
+Splits a recording into mora by aligning its pitch and energy contour to a reference with dynamic time warping.
+The reference is the native speaker's recording from the reference index when there is one, or a template
+built from the word list contour (or the accent type) otherwise. The mora boundaries of the reference are
+carried over along the alignment, so a recording always splits into the expected number of mora.
+"""
+
+def word_list_contour(reading, accent_type):
+    """Returns the relative pitch of each mora from the word lists, or None if the word isn't in them."""
+    entry = get_lexicon().lookup(reading, accent_type)
+    if entry is None or entry["contour"] is None or entry["accent_type"] != accent_type:
+        return None
+    return entry["contour"]
+
+def accent_levels(mora_length, accent_type):
+    """Returns the pitch level (1 high, 0 low) of each mora of a word followed by です, for the accent types
+    grade_pitch_pattern uses: 0 heiban, 1 atamadaka, 2 and 3 drop after that mora, 4 drop at です."""
+    if accent_type == 1:
+        return [1] + [0] * (mora_length - 1)
+    if accent_type in (2, 3):
+        drop = accent_type
+    elif accent_type == 4:
+        drop = mora_length - 2
+    else:
+        drop = mora_length
+    return [0] + [1] * (drop - 1) + [0] * (mora_length - drop)
+
+def template_contour(levels, frames):
+    """Given the pitch level of each mora and the number of frames to fill, returns (contour, energy, boundaries)
+    of a synthetic reference where every mora lasts as long and swells and fades in loudness."""
+    mora_length = len(levels)
+    boundaries = np.linspace(0, frames, mora_length + 1).round().astype(int)
+    lengths = np.diff(boundaries)
+    contour = np.repeat(np.asarray(levels, dtype=float), lengths)
+    energy = np.concatenate([0.5 + 0.5 * np.hanning(length) for length in lengths])
+    return contour, energy, boundaries
+
+
+class DtwParse():
+    """
+    Takes an audio file (or an already decoded signal, or a SpectralFrontEnd) and splits it into mora
+    by aligning it to a reference. Has the same get_clip_bounds / parse_clips / get_mora_pitches as PeakParse.
+    """
+    def __init__(self, file, furigana, accent_type=None, band=DTW_BAND):
+        self._furigana = furigana
+        self._word_array, self._mora = split_word(furigana)
+
+        if isinstance(file, SpectralFrontEnd):
+            self._front_end = file
+        else:
+            self._front_end = SpectralFrontEnd(file)
+        self._original = self._front_end.trimmed_original
+
+        contour, energy = self._front_end.contour_features()
+        self._frames = len(contour)
+        reference_contour, reference_energy, reference_boundaries = self._reference(accent_type)
+
+        path = banded_dtw(normalize_contour(contour, energy),
+                          normalize_contour(reference_contour, reference_energy), band)
+        self._boundaries = map_boundaries(path, reference_boundaries, self._frames)
+
+    def _reference(self, accent_type):
+        """Returns (contour, energy, boundaries) to align against, and notes where it came from in self.reference_source."""
+        index = get_reference_index()
+        reference = index.lookup(self._furigana, accent_type) if index is not None else None
+        if reference is not None and len(reference["boundaries"]) == self._mora + 1:
+            self.reference_source = "native"
+            return reference["contours"], reference["energy"], reference["boundaries"]
+
+        levels = word_list_contour(self._furigana, accent_type)
+        if levels is not None and len(levels) == self._mora:
+            self.reference_source = "word_list"
+        else:
+            levels = accent_levels(self._mora, accent_type)
+            self.reference_source = "accent_type"
+        return template_contour(levels, self._frames)
+
+    def get_clip_bounds(self):
+        """
+        Returns the (start, end) sample indexes of each mora within the trimmed signal.
+        """
+        samples = [self._front_end.frame_to_sample(frame) for frame in self._boundaries]
+        samples[-1] = len(self._original)
+        return list(zip(samples[:-1], samples[1:]))
+
+    def parse_clips(self):
+        """
+        Returns the clip of each mora. Each clip is a view into the trimmed signal.
+        """
+        return [self._original[start:end] for start, end in self.get_clip_bounds()]
+
+    def get_mora_pitches(self):
+        """
+        Returns the pitch of each mora in midi, sliced out of the shared pitch contour.
+        """
+        return self._front_end.mora_pitches(self.get_clip_bounds())
@@ -1,39 +1,28 @@
-import numpy as np
 import math
 
 import librosa
-import librosa.display
-import matplotlib.pyplot as plt
 import soundfile as sf
+from settings import SAMPLING_RATE
+from front_end import SpectralFrontEnd
 
 """
-Given the kanji, find the audio file and split it on the given mora_length
+Given the kanji, find the audio file (or take the decoded signal or SpectralFrontEnd) and split it on the given mora_length
 Only woks if mora length is known, but since we have given words, we know
 what the length should be
 """
 class DurationParse():
-    def __init__(self, kanji, mora_length, file_path):
+    def __init__(self, kanji, mora_length, file_path, sampling_rate=SAMPLING_RATE):
         self._kanji = kanji
 
-        self._original, self._sampling_rate = librosa.load(file_path)
-        S_full, phase = librosa.magphase(librosa.stft(self._original))
-        S_filter = librosa.decompose.nn_filter(S_full,
-                                       aggregate=np.median,
-                                       metric='cosine',
-                                       width=int(librosa.time_to_frames(.1, sr=self._sampling_rate)))
-        S_filter = np.minimum(S_full, S_filter)
-        margin_v = 10
-        power = 2
-        mask_v = librosa.util.softmask(S_full - S_filter,
-                                    margin_v * S_filter,
-                                    power=power)
-
-        S_foreground = mask_v * S_full
-        new_y = librosa.istft(S_foreground*phase)
-
-        _, self._index = librosa.effects.trim(new_y, top_db=40)
+        # Share the spectral analysis (load, voice isolation, trim) with PeakParse if we were handed one
+        if isinstance(file_path, SpectralFrontEnd):
+            front_end = file_path
+        else:
+            front_end = SpectralFrontEnd(file_path, sampling_rate)
+        self._sampling_rate = front_end.sampling_rate
+        self._index = front_end.index
         # print(self._index)
-        self._original = self._original[self._index[0]:self._index[1]]
+        self._original = front_end.trimmed_original
 
         duration = librosa.get_duration(y=self._original)
         self._mora_duration = duration / float(mora_length)
@@ -77,6 +66,7 @@ class DurationParse():
 word_list = ['半分']
 
 if __name__ == "__main__":
+    from plotting import plot_divisions
     for kanji in word_list:
         file_path = "2+2 Noun/" + kanji + ".wav"
         separated = DurationParse(kanji, 5, file_path)
@@ -85,14 +75,4 @@ if __name__ == "__main__":
 
         print(separated.get_original_clip_timestamps())
 
-        times = separated.get_divisions()
-        fig = plt.figure()
-        librosa.display.waveshow(separated._original, sr=separated._sampling_rate, label='waveform')
-        plt.vlines(x = times, ymin = -.15, ymax = .15,
-            colors = 'purple',
-            ls='--',
-            label = 'end timestamp')
-        plt.legend()
-        plt.xlabel("Time")
-        plt.ylabel("Amplitude")
-        plt.show()
\ No newline at end of file
+        plot_divisions(separated._original, separated._sampling_rate, separated.get_divisions())
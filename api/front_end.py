@@ -0,0 +1,184 @@
+import librosa
+import numpy as np
+from settings import SAMPLING_RATE, FRONT_END_N_FFT, HOP_LENGTH, PITCH_FRAME_LENGTH, MORA_PITCH_STATISTIC
+from analysis import get_pitch_contour, mora_pitch_statistics
+from metrics import timed
+
+"""
+Shared spectral front end.
+PeakParse, DurationParse and the pitch analysis all need the same spectrogram of the utterance.
+This runs the stft, voice isolation and trim once, and keeps a frame-level pitch track of the
+whole utterance so mora pitches become slices over precomputed frames.
+"""
+
+class SpectralFrontEnd():
+    """
+    Takes an audio file (or an already decoded signal) and runs every piece of spectral analysis a grade needs, once.
+    Exposes the magnitude, the foreground mask, the isolated and trimmed signals, and a frame-level pitch track.
+    """
+    def __init__(self, file, sampling_rate=SAMPLING_RATE, stft=None, pitch_contour=None, checkpoint=None):
+        """stft and pitch_contour may be passed in if they were already computed (ie. while the audio was streaming in).
+        They must match librosa.stft(signal, n_fft=FRONT_END_N_FFT, hop_length=HOP_LENGTH) and get_pitch_contour(signal).
+        checkpoint, if given, is called before each stage and can raise to stop the analysis early (see grading.grade_signal)."""
+        if checkpoint is None:
+            checkpoint = lambda: None
+        if isinstance(file, str):
+            self._signal, self._sampling_rate = librosa.load(file)
+        else:
+            self._signal, self._sampling_rate = file, sampling_rate
+
+        # a single stft shared by the voice isolation and the pitch track
+        checkpoint()
+        with timed("stft"):
+            if stft is None:
+                stft = librosa.stft(self._signal, n_fft=FRONT_END_N_FFT, hop_length=HOP_LENGTH)
+            S_full, self._phase = librosa.magphase(stft)
+            self._magnitude = S_full
+
+        # Voice Isolate
+        checkpoint()
+        with timed("voice_isolation"):
+            S_filter = librosa.decompose.nn_filter(S_full,
+                                           aggregate=np.median,
+                                           metric='cosine',
+                                           width=int(librosa.time_to_frames(.1, sr=self._sampling_rate, hop_length=HOP_LENGTH)))
+            S_filter = np.minimum(S_full, S_filter)
+            margin_v = 10
+            power = 2
+            self._mask = librosa.util.softmask(S_full - S_filter,
+                                        margin_v * S_filter,
+                                        power=power)
+
+            S_foreground = self._mask * S_full
+            self._foreground = librosa.istft(S_foreground * self._phase, hop_length=HOP_LENGTH, length=len(self._signal))
+
+        # Trim the silence from the beginning and end
+        checkpoint()
+        with timed("trim"):
+            self._trimmed, self._index = librosa.effects.trim(self._foreground, top_db=40)
+
+        self._pitch_track = None
+        self._pitch_contour = pitch_contour
+        self._energy = None
+
+    @property
+    def sampling_rate(self):
+        return self._sampling_rate
+
+    @property
+    def signal(self):
+        """The untouched input signal."""
+        return self._signal
+
+    @property
+    def magnitude(self):
+        """Magnitude spectrogram of the input signal."""
+        return self._magnitude
+
+    @property
+    def mask(self):
+        """Soft mask that picks the voice (foreground) out of the magnitude spectrogram."""
+        return self._mask
+
+    @property
+    def foreground(self):
+        """The voice isolated signal, before trimming."""
+        return self._foreground
+
+    @property
+    def trimmed(self):
+        """The voice isolated signal with leading and trailing silence trimmed."""
+        return self._trimmed
+
+    @property
+    def index(self):
+        """(start, end) sample indexes of the trimmed region within the input signal."""
+        return self._index
+
+    @property
+    def trimmed_original(self):
+        """The input signal cut to the trimmed region. A view, no samples are copied."""
+        return self._signal[self._index[0]:self._index[1]]
+
+    @property
+    def pitch_track(self):
+        """Frame-level pitch (Hz) of the input signal, taken from the strongest bin in each frame.
+        Computed from the shared magnitude the first time it is asked for."""
+        if self._pitch_track is None:
+            pitches, magnitudes = librosa.core.piptrack(S=self._magnitude, sr=self._sampling_rate,
+                                                        n_fft=FRONT_END_N_FFT, hop_length=HOP_LENGTH)
+            max_indexes = np.argmax(magnitudes, axis=0)
+            self._pitch_track = pitches[max_indexes, np.arange(magnitudes.shape[1])]
+        return self._pitch_track
+
+    @property
+    def pitch_contour(self):
+        """(f0, voiced) contour of the whole input signal from get_pitch_contour, one value per pitch track frame.
+        Computed the first time it is asked for."""
+        if self._pitch_contour is None:
+            with timed("pitch_contour"):
+                self._pitch_contour = get_pitch_contour(self._signal, self._sampling_rate)
+        return self._pitch_contour
+
+    @property
+    def energy(self):
+        """rms of each pitch track frame of the input signal. Computed the first time it is asked for."""
+        if self._energy is None:
+            self._energy = librosa.feature.rms(y=self._signal, frame_length=PITCH_FRAME_LENGTH, hop_length=HOP_LENGTH)[0]
+        return self._energy
+
+    def contour_features(self):
+        """Returns (contour, energy) over the frames of the trimmed region, as float32 arrays.
+        contour is the pitch in midi, nan where unvoiced. energy is the rms scaled so the loudest frame is 1."""
+        first, last = self.frames(0, len(self.trimmed_original))
+        f0, voiced = self.pitch_contour
+        contour = np.where(voiced, librosa.hz_to_midi(np.maximum(f0, 1e-6)), np.nan)[first:last]
+        energy = self.energy[first:last]
+        energy = energy / max(float(np.max(energy)), 1e-9)
+        return contour.astype(np.float32), energy.astype(np.float32)
+
+    def frame_to_sample(self, frame):
+        """Inverse of frames: given a frame counted from the start of the trimmed region,
+        returns the sample of the trimmed signal it starts at."""
+        first, _ = self.frames(0, len(self.trimmed_original))
+        sample = int(librosa.frames_to_samples(first + frame, hop_length=HOP_LENGTH)) - self._index[0]
+        return min(max(sample, 0), len(self.trimmed_original))
+
+    def frames(self, start, end):
+        """Given sample indexes into the trimmed signal, returns the (first, last + 1) pitch track frames covering them."""
+        offset = self._index[0]
+        n_frames = self._magnitude.shape[1]
+        first = min(int(librosa.samples_to_frames(offset + start, hop_length=HOP_LENGTH)), n_frames - 1)
+        last = min(max(int(librosa.samples_to_frames(offset + end, hop_length=HOP_LENGTH)), first + 1), n_frames)
+        return (first, last)
+
+    def mora_statistics(self, bounds):
+        """Given (start, end) sample indexes of each mora within the trimmed signal, returns the
+        median, trimmed_mean and voiced_fraction of each mora's pitch (see mora_pitch_statistics)."""
+        f0, voiced = self.pitch_contour
+        frame_bounds = [self.frames(start, end) for start, end in bounds]
+        return mora_pitch_statistics(f0, voiced, frame_bounds)
+
+    def mora_pitches(self, bounds):
+        """Given (start, end) sample indexes of each mora within the trimmed signal, returns the pitch of each mora in midi.
+        The summary used is set by MORA_PITCH_STATISTIC. "middle_frame" keeps the old get_pitch_info
+        behaviour of taking the piptrack pitch of the middle frame."""
+        if MORA_PITCH_STATISTIC != "middle_frame":
+            return list(self.mora_statistics(bounds)[MORA_PITCH_STATISTIC])
+
+        track = self.pitch_track
+        pitches = []
+        for start, end in bounds:
+            first, last = self.frames(start, end)
+            frames = track[first:last]
+            pitches.append(librosa.hz_to_midi(frames[len(frames) // 2]))
+        return pitches
+
+def warm_up_front_end(sampling_rate=SAMPLING_RATE):
+    """Runs the whole front end once over a second of synthetic voice.
+    The first stft, nn_filter and pitch contour in a process pay for librosa's lazy imports and numba compilation."""
+    time = np.arange(sampling_rate) / sampling_rate
+    tone = (0.1 * np.sin(2 * np.pi * 220 * time) * np.hanning(sampling_rate)).astype(np.float32)
+    front_end = SpectralFrontEnd(tone, sampling_rate)
+    front_end.pitch_contour
+    front_end.energy
@@ -0,0 +1,98 @@
+from functools import cached_property
+import numpy as np
+import librosa
+from settings import (GATES, SAMPLING_RATE, HOP_LENGTH, PITCH_FRAME_LENGTH, MIN_DURATION, MAX_DURATION,
+                      MIN_PEAK_RMS, CLIP_LEVEL, MAX_CLIPPED_FRACTION, MIN_VOICED_FRACTION,
+                      MIN_MORA_SECONDS, MAX_MORA_SECONDS)
+from analysis import voiced_frames
+from metrics import timed, count
+
+"""
+Cheap checks a decoded recording has to pass before any of the expensive stages (stft, voice isolation,
+splitting into mora, whisper) run on it. An empty, silent or clipped recording, or one far too short or long
+for the word, is turned away in a few milliseconds with an error saying what was wrong with it.
+The gates, and the order they run in, are set by GATES in settings.py.
+"""
+
+class RecordingRejected(Exception):
+    """Raised when a recording fails a gate. gate is the name of the gate that turned it away."""
+    def __init__(self, gate, message):
+        super().__init__(message)
+        self.gate = gate
+
+    def __reduce__(self):
+        # so it survives being sent back from a worker process.
+        return (RecordingRejected, (self.gate, str(self)))
+
+
+class GateInput():
+    """
+    A recording being gated. The frame loudness is only measured if a gate asks for it, and then only once.
+    """
+    def __init__(self, signal, mora_length, sampling_rate=SAMPLING_RATE):
+        self.signal = signal
+        self.mora_length = mora_length
+        self.sampling_rate = sampling_rate
+
+    @property
+    def duration(self):
+        return len(self.signal) / self.sampling_rate
+
+    @cached_property
+    def frame_rms(self):
+        if len(self.signal) == 0:
+            return np.zeros(1)
+        return librosa.feature.rms(y=self.signal, frame_length=PITCH_FRAME_LENGTH, hop_length=HOP_LENGTH)[0]
+
+    @cached_property
+    def voiced(self):
+        """Flags the voiced frames, the same way the pitch contour does."""
+        return voiced_frames(self.frame_rms) & (self.frame_rms >= MIN_PEAK_RMS)
+
+    @property
+    def voiced_seconds(self):
+        return np.count_nonzero(self.voiced) * HOP_LENGTH / self.sampling_rate
+
+
+def duration_gate(recording):
+    if recording.duration < MIN_DURATION:
+        raise RecordingRejected("duration", "the recording is too short. hold the button down while saying the word.")
+    if recording.duration > MAX_DURATION:
+        raise RecordingRejected("duration", f"the recording is longer than {MAX_DURATION} seconds.")
+
+def loudness_gate(recording):
+    if recording.frame_rms.max() < MIN_PEAK_RMS:
+        raise RecordingRejected("loudness", "the recording is silent. check that the microphone is working.")
+    clipped = np.count_nonzero(np.abs(recording.signal) >= CLIP_LEVEL) / len(recording.signal)
+    if clipped > MAX_CLIPPED_FRACTION:
+        raise RecordingRejected("loudness", "the recording is clipped. speak more softly or further from the microphone.")
+
+def voiced_gate(recording):
+    if np.mean(recording.voiced) < MIN_VOICED_FRACTION:
+        raise RecordingRejected("voiced", "no speech was found in the recording.")
+
+def mora_count_gate(recording):
+    seconds = recording.voiced_seconds
+    if seconds < MIN_MORA_SECONDS * recording.mora_length:
+        raise RecordingRejected("mora_count", f"the recording is too short to hold {recording.mora_length} mora.")
+    if seconds > MAX_MORA_SECONDS * recording.mora_length:
+        raise RecordingRejected("mora_count", f"the recording is too long to hold only {recording.mora_length} mora.")
+
+GATE_FUNCTIONS = {
+    "duration": duration_gate,
+    "loudness": loudness_gate,
+    "voiced": voiced_gate,
+    "mora_count": mora_count_gate,
+}
+
+def check_recording(signal, mora_length, gates=GATES):
+    """Runs a decoded recording through the gates, in order.
+    Raises RecordingRejected at the first one it fails."""
+    with timed("gates"):
+        recording = GateInput(signal, mora_length)
+        for gate in gates:
+            try:
+                GATE_FUNCTIONS[gate](recording)
+            except RecordingRejected:
+                count("gate_rejections", gate=gate)
+                raise
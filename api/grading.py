@@ -1,28 +1,288 @@
 # from sys import exit, stderr
 import os.path
 # import argparse
-from settings import BASE_GRADE
-from preprocessing import preliminary_pronunciation_check
-from analysis import grade_pitch_pattern
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from settings import (BASE_GRADE, BATCH_DSP_WORKERS, REFERENCE_WEIGHT, GRADING_ENGINE, CONCURRENT_ASR, WHISPER_INPUT,
+                      MODEL_POOL_SIZE)
+from preprocessing import preliminary_pronunciation_check, preliminary_pronunciation_check_batch
+from analysis import grade_pitch_pattern, get_pitch_info
+from decoding import decode_audio, DecodeError
+from peak_parse import PeakParse
+from dtw_parse import DtwParse
+from front_end import SpectralFrontEnd
+from utilities import split_word
+from reference_index import get_reference_index, compare_to_reference
+from result_cache import lookup, store, make_result
+from gates import check_recording, RecordingRejected
+from metrics import timed, count
 
-def calculate_grade(sf, sf_array, word, word_array, accent_type):
+class SyllableSplitError(Exception):
+    """Raised when a recording can't be split into the expected number of mora."""
+    pass
+
+class GradeCancelled(Exception):
+    """Raised inside a grade when whisper has already ruled the recording out, so its signal processing can stop."""
+    pass
+
+def calculate_grade(sf, sf_array, word, word_array, accent_type, pitches=None, coefficient=None, region=None):
     """Grade the input sound clip given 5 arguments:
     Takes in the sound clip (sf), the full word (word), and the
     pitch accent pattern type.
     Also expects to be passed in a set of parallel arrays that has the sound clips and words broken
-    down into its individual mora.
+    down into its individual mora. Sound clips may be file paths or decoded signals.
+    If the pitch of each mora has already been measured it can be passed in as pitches,
+    and likewise the coefficient from the whisper check.
+    region is the (start, end) samples of the voiced part of sf, if known, so whisper can skip the silence.
     Returns a number value between 0 and 100 representing accuracy of pronunciation."""
     grade = 0
-    coefficient = preliminary_pronunciation_check(sf, word)
+    if coefficient is None:
+        coefficient = preliminary_pronunciation_check(sf, word, region=region)
     print(f"Coefficient = {coefficient}")
 
     if coefficient != 0: # if it is worth it to grade the sound file
         # start with a base value that will be weighted according to the coefficient found.
         grade += BASE_GRADE
-        grade += (100 - BASE_GRADE) * grade_pitch_pattern(soundfiles=sf_array, accent_type=accent_type, word=word_array)
+        if pitches is None:
+            with timed("mora_pitch"):
+                pitches = [get_pitch_info(mora) for mora in sf_array]
+        with timed("scoring"):
+            pitch_grade = grade_pitch_pattern(soundfiles=sf_array, accent_type=accent_type, word=word_array, pitches=pitches)
+            grade += (100 - BASE_GRADE) * blend_reference_grade(pitch_grade, pitches, word, word_array, accent_type)
 
     return coefficient * grade
 
+def blend_reference_grade(pitch_grade, pitches, word, word_array, accent_type):
+    """Mixes REFERENCE_WEIGHT of the comparison against the native speaker's recording into the pitch grade.
+    Returns the pitch grade unchanged if that's turned off, or there is no usable reference for the word."""
+    index = get_reference_index() if REFERENCE_WEIGHT else None
+    reference = index.lookup(word, accent_type) if index is not None else None
+    if reference is None:
+        return pitch_grade
+
+    similarity = compare_to_reference(pitches, word_array, reference)
+    if similarity is None:
+        return pitch_grade
+    print(f"Reference similarity = {similarity}")
+    return (1 - REFERENCE_WEIGHT) * pitch_grade + REFERENCE_WEIGHT * similarity
+
+def analyse_recording(audio, word, accent_type=None):
+    """Runs the signal processing half of a grade: decode, voice isolation, split into mora, and mora pitches.
+    audio is the encoded file as bytes, or the already decoded signal. accent_type picks the reference when splitting with dtw.
+    Returns a tuple (signal, clips, pitches, region), see split_front_end.
+    Raises DecodeError, RecordingRejected or SyllableSplitError if the recording can't be graded."""
+    if isinstance(audio, np.ndarray):
+        signal = audio
+    else:
+        # decode straight into memory. nothing is written to disk for the rest of the grade.
+        signal = decode_audio(audio)
+        print("finished decoding audio")
+
+    # turn away empty, silent or clipped recordings before anything expensive runs on them.
+    check_recording(signal, split_word(word)[1])
+
+    # stft, voice isolation, trim and pitch track all happen once here and are shared by every stage below.
+    return split_front_end(SpectralFrontEnd(signal), word, accent_type)
+
+def decode_cached(audio, word, accent_type):
+    """Decodes a recording, unless its grade is already in the result cache.
+    Returns (signal, keys, result): result is the cached result, or None with signal decoded,
+    and keys are the cache keys to store the grade under once it is worked out."""
+    upload_key, result = lookup(audio, word, accent_type)
+    if result is not None:
+        return None, [], result
+
+    signal = decode_audio(audio)
+    print("finished decoding audio")
+    signal_key, result = lookup(signal, word, accent_type)
+    if result is not None:
+        # the same recording, uploaded as different bytes. remember these bytes too.
+        store([upload_key], result)
+    return signal, [upload_key, signal_key], result
+
+def check_cancelled(cancelled):
+    """Raises GradeCancelled if the cancelled event (a threading.Event, or None) is set."""
+    if cancelled is not None and cancelled.is_set():
+        raise GradeCancelled()
+
+def split_front_end(front_end, word, accent_type=None, cancelled=None):
+    """Splits an already analysed recording into mora with the GRADING_ENGINE. Returns a tuple (signal, clips, pitches, region)
+    where region is the (start, end) samples of the voiced part of the signal.
+    Raises SyllableSplitError if the recording doesn't split into the expected number of mora
+    (which can only happen with peak_parse, dtw always produces one clip per mora),
+    or GradeCancelled once the cancelled event is set."""
+    _, mora_length = split_word(word)
+    check_cancelled(cancelled)
+    signal = front_end.signal
+    with timed("segmentation"):
+        try:
+            if GRADING_ENGINE == "dtw":
+                gp = DtwParse(front_end, word, accent_type)
+            else:
+                gp = PeakParse(front_end, word, mora_length)
+            syllable_clips = gp.parse_clips()
+        except (IndexError, ValueError) as e:
+            # ie. a recording with no syllable peaks at all
+            count("split_failures", engine=GRADING_ENGINE, reason="no_syllables")
+            raise SyllableSplitError("no syllables were found in the recording.") from e
+
+    if len(syllable_clips) != mora_length:
+        count("split_failures", engine=GRADING_ENGINE,
+              reason="too_few_mora" if len(syllable_clips) < mora_length else "too_many_mora")
+        raise SyllableSplitError("incorrect number of syllables detected.")
+    print("finished splicing audio into mora")
+    check_cancelled(cancelled)
+
+    # clips are views into the trimmed signal, and their pitches are slices of the shared pitch track.
+    with timed("mora_pitch"):
+        pitches = gp.get_mora_pitches()
+    return signal, syllable_clips, pitches, front_end.index
+
+_asr_executor = None
+_asr_executor_lock = threading.Lock()
+
+def submit_pronunciation_check(signal, word, region, cancelled):
+    """Starts preliminary_pronunciation_check in a background thread and returns its future.
+    Sets the cancelled event if the coefficient comes back 0."""
+    global _asr_executor
+    with _asr_executor_lock:
+        if _asr_executor is None:
+            # more threads than model instances would only queue up for a model.
+            _asr_executor = ThreadPoolExecutor(max_workers=MODEL_POOL_SIZE, thread_name_prefix="asr")
+
+    def cancel_if_ruled_out(future):
+        if not future.cancelled() and future.exception() is None and future.result() == 0:
+            cancelled.set()
+
+    # run in a copy of this thread's context, so the check's timings still count towards this request.
+    future = _asr_executor.submit(contextvars.copy_context().run, preliminary_pronunciation_check, signal, word, region=region)
+    future.add_done_callback(cancel_if_ruled_out)
+    return future
+
+def grade_signal(signal, word, accent_type, stft=None, pitch_contour=None):
+    """Grades a decoded recording. A streamed in one passes the stft and pitch_contour its RollingAnalysis already computed.
+    With CONCURRENT_ASR, whisper runs in a background thread while the signal processing runs here, and the
+    signal processing stops early if whisper rules the recording out, so a grade takes as long as the slower of the two.
+    Returns (grade, coefficient, pitches, region). Raises RecordingRejected or SyllableSplitError if it can't be graded."""
+    word_array, mora_length = split_word(word)
+    # turn away empty, silent or clipped recordings before anything expensive runs on them.
+    check_recording(signal, mora_length)
+
+    cancelled = threading.Event()
+    asr = None
+    if CONCURRENT_ASR and WHISPER_INPUT != "cropped":
+        asr = submit_pronunciation_check(signal, word, None, cancelled)
+
+    front_end = None
+    try:
+        # stft, voice isolation, trim and pitch track all happen once here and are shared by every stage below.
+        # whisper can rule the recording out while they run, so each stage first checks it hasn't.
+        front_end = SpectralFrontEnd(signal, stft=stft, pitch_contour=pitch_contour,
+                                     checkpoint=lambda: check_cancelled(cancelled))
+        if CONCURRENT_ASR and asr is None:
+            # cropped whisper input needs the voiced region, so it can only start once voice isolation found it.
+            asr = submit_pronunciation_check(signal, word, front_end.index, cancelled)
+        signal, syllable_clips, pitches, region = split_front_end(front_end, word, accent_type, cancelled)
+    except GradeCancelled:
+        print("Coefficient = 0, skipped the rest of the signal processing")
+        count("grades", outcome="ruled_out")
+        return 0.0, 0.0, None, None if front_end is None else front_end.index
+    except BaseException:
+        # the grade failed (ie. a SyllableSplitError), so its whisper check is no longer needed.
+        # one still waiting for a thread never starts; a running one can't be interrupted and finishes on its own.
+        cancelled.set()
+        if asr is not None:
+            asr.cancel()
+        raise
+
+    if asr is not None:
+        coefficient = asr.result()
+    else:
+        coefficient = preliminary_pronunciation_check(signal, word, region=region)
+    grade = round(calculate_grade(signal, syllable_clips, word, word_array, accent_type,
+                                  pitches=pitches, coefficient=coefficient, region=region), 1)
+    count("grades", outcome="graded" if coefficient != 0 else "ruled_out")
+    return grade, coefficient, pitches, region
+
+def grade_recording(audio, word, accent_type):
+    """Runs the whole grade for one uploaded recording: decode, then grade_signal.
+    audio is the encoded file as bytes. Returns the grade rounded to one decimal.
+    Recordings already graded come straight from the result cache.
+    Raises DecodeError, RecordingRejected or SyllableSplitError if the recording can't be graded.
+    Only touches memory, so any number of these can run at once."""
+    signal, keys, result = decode_cached(audio, word, accent_type)
+    if result is not None:
+        return result["grade"]
+
+    grade, coefficient, pitches, region = grade_signal(signal, word, accent_type)
+    store(keys, make_result(grade, coefficient, pitches, region))
+    return grade
+
+def grade_stream(signal, stft, pitch_contour, word, accent_type):
+    """Grades a recording that was streamed in, from what its RollingAnalysis computed (see streaming.py).
+    Returns the grade rounded to one decimal.
+    Raises RecordingRejected or SyllableSplitError if the recording can't be graded."""
+    key, result = lookup(signal, word, accent_type)
+    if result is not None:
+        return result["grade"]
+
+    grade, coefficient, pitches, region = grade_signal(signal, word, accent_type, stft, pitch_contour)
+    store([key], make_result(grade, coefficient, pitches, region))
+    return grade
+
+def grade_batch(items):
+    """Grades many recordings at once. items is a list of (audio, word, accent_type) tuples, with audio as bytes.
+    Returns a list parallel to items of either {"grade": grade} or {"error": message} (plus "gate" if a gate turned it away).
+    The signal processing of every item runs in parallel threads, then whisper checks all the
+    recordings that survived in batched forward passes."""
+    results = [None] * len(items)
+    analysed = {}
+    keys = {}
+
+    def analyse(audio, word, accent_type):
+        signal, cache_keys, result = decode_cached(audio, word, accent_type)
+        if result is not None:
+            return cache_keys, result
+        return cache_keys, analyse_recording(signal, word, accent_type)
+
+    with ThreadPoolExecutor(max_workers=BATCH_DSP_WORKERS) as executor:
+        # each item runs in its own copy of this thread's context, so its timings and counts still count towards this request.
+        futures = [executor.submit(contextvars.copy_context().run, analyse, audio, word, accent_type)
+                   for audio, word, accent_type in items]
+        for i, future in enumerate(futures):
+            try:
+                keys[i], outcome = future.result()
+            except DecodeError:
+                results[i] = {"error": "ffmpeg failed to convert audio"}
+            except RecordingRejected as e:
+                results[i] = {"error": str(e), "gate": e.gate}
+            except SyllableSplitError as e:
+                results[i] = {"error": str(e)}
+            else:
+                if isinstance(outcome, dict):
+                    results[i] = {"grade": outcome["grade"]}
+                else:
+                    analysed[i] = outcome
+
+    indexes = sorted(analysed)
+    coefficients = preliminary_pronunciation_check_batch([analysed[i][0] for i in indexes],
+                                                         [items[i][1] for i in indexes],
+                                                         [analysed[i][3] for i in indexes])
+
+    for i, coefficient in zip(indexes, coefficients):
+        _, word, accent_type = items[i]
+        signal, syllable_clips, pitches, region = analysed[i]
+        word_array, _ = split_word(word)
+        grade = round(calculate_grade(signal, syllable_clips, word, word_array, accent_type,
+                                      pitches=pitches, coefficient=coefficient), 1)
+        store(keys[i], make_result(grade, coefficient, pitches, region))
+        count("grades", outcome="graded" if coefficient != 0 else "ruled_out")
+        results[i] = {"grade": grade}
+
+    return results
+
 # intended to be used in the command line while in development.
 # def init_parser():
 #     parser = argparse.ArgumentParser(allow_abbrev=False,
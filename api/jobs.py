@@ -0,0 +1,135 @@
+import time
+import uuid
+import queue
+import threading
+
+from settings import JOB_WORKERS, JOB_QUEUE_SIZE, JOB_RESULT_TTL
+from metrics import collect
+
+"""
+Asynchronous grading.
+A job is queued and answered with its id right away, and the client polls for the result, so a slow grade
+never holds a request (and the proxy in front of it) open. Jobs are run by JOB_WORKERS threads of this
+process from a queue of at most JOB_QUEUE_SIZE waiting jobs; no broker is needed. Finished jobs are kept
+for JOB_RESULT_TTL seconds so they can be polled (and polled again) before they are dropped.
+"""
+
+class JobQueueFullError(Exception):
+    """Raised when JOB_QUEUE_SIZE jobs are already waiting."""
+    pass
+
+class UnknownJobError(Exception):
+    """Raised when a job id doesn't exist (or its result has expired)."""
+    pass
+
+
+class Job():
+    """
+    One queued call. status goes from "queued" to "running" to either "done" or "failed".
+    timings fills up with {stage: seconds} while it runs, so polling it shows how far along it is.
+    """
+    def __init__(self, fn, args, key=None):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.status = "queued"
+        self.result = None
+        self.error = None # {"error": message, ...} once it has failed
+        self.timings = {}
+        self._fn = fn
+        self._args = args
+        self._created = time.monotonic()
+        self._started = None
+        self.finished = None
+
+    def run(self, describe_error):
+        self._started = time.monotonic()
+        self.status = "running"
+        with collect() as collection:
+            self.timings = collection.timings
+            try:
+                self.result = self._fn(*self._args)
+                self.status = "done"
+            except Exception as e:
+                self.error = describe_error(e)
+                self.status = "failed"
+        self.finished = time.monotonic()
+        self._fn = self._args = None # let go of the audio
+
+    def to_dict(self):
+        """Returns the job as it should be reported to the client."""
+        now = time.monotonic()
+        job = {
+            "job_id": self.id,
+            "status": self.status,
+            "queued_seconds": (self._started or now) - self._created,
+            "timings": dict(self.timings),
+        }
+        if self._started is not None:
+            job["run_seconds"] = (self.finished or now) - self._started
+        if self.status == "done":
+            job["result"] = self.result
+        elif self.status == "failed":
+            job.update(self.error)
+        return job
+
+
+def describe_exception(e):
+    """Default description of a failed job's exception: {"error": message}."""
+    return {"error": str(e)}
+
+class JobQueue():
+    """
+    Runs jobs in `workers` background threads. At most `max_queued` jobs wait to run,
+    and finished jobs are dropped `ttl` seconds after they finish.
+    describe_error turns the exception of a failed job into the dict reported as its error.
+    """
+    def __init__(self, workers=JOB_WORKERS, max_queued=JOB_QUEUE_SIZE, ttl=JOB_RESULT_TTL, describe_error=describe_exception):
+        self._ttl = ttl
+        self._describe_error = describe_error
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._jobs = {}
+        self._keys = {}
+        self._lock = threading.Lock()
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True).start()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            job.run(self._describe_error)
+
+    def _expire(self):
+        now = time.monotonic()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished is not None and now - job.finished > self._ttl:
+                del self._jobs[job_id]
+                if job.key is not None:
+                    self._keys.pop(job.key, None)
+
+    def submit(self, fn, *args, key=None):
+        """Queues fn(*args) and returns the job id.
+        A job submitted again with the same key (ie. a client retrying a request whose response it lost)
+        gets the id of the first one, as long as that one hasn't expired, instead of running twice."""
+        with self._lock:
+            self._expire()
+            if key is not None and key in self._keys:
+                return self._keys[key]
+
+            job = Job(fn, args, key)
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                raise JobQueueFullError("too many grades are waiting, try again shortly.")
+            self._jobs[job.id] = job
+            if key is not None:
+                self._keys[key] = job.id
+        return job.id
+
+    def get(self, job_id):
+        """Returns the job as a dict (see Job.to_dict)."""
+        with self._lock:
+            self._expire()
+            job = self._jobs.get(job_id)
+        if job is None:
+            raise UnknownJobError("unknown or expired job.")
+        return job.to_dict()
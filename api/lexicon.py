@@ -0,0 +1,109 @@
+import threading
+from settings import WORD_LIST_DIRECTORY
+from word_lists import load_word_lists, SUFFIX
+from utilities import convert, split_word, data
+
+"""
+The words the app teaches, with everything the grader needs to know about them worked out once.
+Built from the word lists (see word_lists.py) and utilities.data the first time it is used, so
+converting or splitting a known word never touches pykakasi while a request is being graded.
+"""
+
+def make_entry(kanji, reading, accent_type=None, contour=None, english=None, category=None):
+    """Returns the lexicon entry of a word. stem is the reading without the です it (usually) ends in."""
+    mora, mora_length = split_word(reading)
+    suffix = "".join(SUFFIX)
+    stem = reading[:-len(suffix)] if reading.endswith(suffix) else reading
+    return {
+        "kanji": kanji,
+        "reading": reading,
+        "romaji": convert(reading)[1],
+        "stem": stem,
+        "stem_romaji": convert(stem)[1],
+        "mora": mora,
+        "mora_length": mora_length,
+        "accent_type": accent_type,
+        "contour": contour,
+        "english": english,
+        "category": category,
+    }
+
+
+class Lexicon():
+    """
+    Word entries, looked up by kanji (with or without です) or by reading.
+    Several words can share a reading (ie. 日本 and 二本), so lookups by reading can narrow by accent type.
+    """
+    def __init__(self, entries):
+        self._entries = entries
+        self._by_text = {}
+        self._by_reading = {}
+        for entry in entries:
+            self._by_text[entry["kanji"]] = entry
+            self._by_text.setdefault(entry["kanji"] + "".join(SUFFIX), entry)
+            self._by_reading.setdefault(entry["reading"], []).append(entry)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def readings(self):
+        """Returns every distinct reading, sorted."""
+        return sorted(self._by_reading)
+
+    def matches(self, text, accent_type=None):
+        """Returns every entry a kanji (ie. 日本 or 日本です) or a reading (にほんです) could mean, words whose accent type
+        is known first. A kanji means one word; a reading can be shared by several (ie. 日本 and 二本), which
+        accent_type narrows down to the ones with that accent."""
+        if text in self._by_text:
+            return [self._by_text[text]]
+
+        candidates = self._by_reading.get(text, [])
+        if accent_type is not None:
+            candidates = [entry for entry in candidates if entry["accent_type"] in (accent_type, None)]
+        return sorted(candidates, key=lambda entry: entry["accent_type"] is None)
+
+    def lookup(self, text, accent_type=None):
+        """Returns the first of matches(text, accent_type), or None if the text isn't known.
+        Use matches to tell whether a reading without an accent_type is ambiguous."""
+        candidates = self.matches(text, accent_type)
+        return candidates[0] if candidates else None
+
+    def spelling(self, text):
+        """Returns the (hiragana, romaji) of exactly the given text, or None if it isn't a known word.
+        Unlike lookup, a bare kanji (日本) reads without the です of its entry (にほん, not にほんです),
+        so a transcription that leaves out です doesn't match the expected text."""
+        entry = self.lookup(text)
+        if entry is None:
+            return None
+        if text == entry["kanji"] or text == entry["stem"]:
+            return entry["stem"], entry["stem_romaji"]
+        return entry["reading"], entry["romaji"]
+
+
+def build_lexicon(directory=WORD_LIST_DIRECTORY):
+    """Builds the lexicon. Word list entries win over utilities.data ones for the same kanji."""
+    entries = {}
+    for kanji, reading, _ in data:
+        entries[kanji] = make_entry(kanji, reading)
+    try:
+        words = load_word_lists(directory)
+    except OSError:
+        words = []
+    for word in words:
+        entries[word["kanji"]] = make_entry(word["kanji"], word["reading"], word["accent_type"], word["contour"],
+                                            word["english"], word["category"])
+    return Lexicon(list(entries.values()))
+
+_lexicon = None
+_lexicon_lock = threading.Lock()
+
+def get_lexicon():
+    """Returns the process-wide lexicon, building it on first use."""
+    global _lexicon
+    with _lexicon_lock:
+        if _lexicon is None:
+            _lexicon = build_lexicon()
+    return _lexicon
@@ -0,0 +1,148 @@
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+
+"""
+Timings and counts of the stages of a grade.
+Every timed stage goes into a process-wide latency histogram, and every counted event (ie. a split failure
+and its reason) into a process-wide counter. Both are also added to the collection of the request being
+handled (if one is collecting), so a response can report where its own time went.
+prometheus_text renders the process-wide numbers for /metrics.
+"""
+
+# upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# help text of the counters on /metrics.
+COUNTERS = {
+    "grades": "Grades worked out, by outcome: graded, or ruled_out by whisper (a coefficient of 0).",
+    "result_cache": "Result cache lookups, by result.",
+    "gate_rejections": "Recordings turned away by a gate, by gate.",
+    "split_failures": "Recordings that couldn't be split into mora, by grading engine and reason.",
+    "decode_failures": "Uploads that couldn't be decoded.",
+}
+
+_histograms = {}
+_counters = {}
+_lock = threading.Lock()
+_current = contextvars.ContextVar("collection", default=None)
+
+
+class Collection():
+    """
+    The timings ({stage: seconds}) and counts ({(name, labels): amount}) of one request or job.
+    labels is a sorted tuple of (label, value) pairs.
+    """
+    def __init__(self):
+        self.timings = {}
+        self.counts = {}
+
+    def debug_summary(self):
+        """Returns the collection as a json friendly dict, with timings in milliseconds."""
+        counts = {}
+        for (name, labels), amount in self.counts.items():
+            counts[",".join([name] + [f"{label}={value}" for label, value in labels])] = amount
+        return {"timings_ms": {stage: round(seconds * 1000, 1) for stage, seconds in self.timings.items()},
+                "counts": counts}
+
+
+def record(stage, seconds):
+    """Adds one run of a stage that took the given number of seconds."""
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = {"buckets": [0] * len(LATENCY_BUCKETS), "count": 0, "sum": 0.0}
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        if bucket < len(LATENCY_BUCKETS):
+            histogram["buckets"][bucket] += 1
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+
+    collection = _current.get()
+    if collection is not None:
+        collection.timings[stage] = collection.timings.get(stage, 0.0) + seconds
+
+def count(name, amount=1, **labels):
+    """Adds amount to a counter, ie. count("split_failures", engine="peak_parse", reason="too_few_mora")."""
+    key = (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+    collection = _current.get()
+    if collection is not None:
+        collection.counts[key] = collection.counts.get(key, 0) + amount
+
+@contextmanager
+def timed(stage):
+    """Context manager that records how long its block took under the given stage name."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+def start_collecting():
+    """Starts collecting the timings and counts of everything run from here on (in this context).
+    Returns (collection, token). collection is a Collection that fills up as stages run, and token goes to stop_collecting."""
+    collection = Collection()
+    return collection, _current.set(collection)
+
+def stop_collecting(token):
+    _current.reset(token)
+
+@contextmanager
+def collect():
+    """Context manager version of start_collecting that yields the Collection."""
+    collection, token = start_collecting()
+    try:
+        yield collection
+    finally:
+        stop_collecting(token)
+
+def merge(collection):
+    """Records a collection made somewhere else (ie. in a worker process) as if it ran here."""
+    for stage, seconds in collection.timings.items():
+        record(stage, seconds)
+    for (name, labels), amount in collection.counts.items():
+        count(name, amount, **dict(labels))
+
+def snapshot():
+    """Returns the totals so far as {stage: {"count": runs, "total_seconds": seconds}}."""
+    with _lock:
+        return {stage: {"count": histogram["count"], "total_seconds": histogram["sum"]}
+                for stage, histogram in _histograms.items()}
+
+def server_timing(timings):
+    """Formats collected timings as a Server-Timing header value (durations in milliseconds)."""
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+def _labels(pairs):
+    return "{" + ",".join(f'{label}="{value}"' for label, value in pairs) + "}" if pairs else ""
+
+def prometheus_text():
+    """Renders the stage histograms and the counters in the prometheus text exposition format."""
+    with _lock:
+        histograms = {stage: {"buckets": list(h["buckets"]), "count": h["count"], "sum": h["sum"]}
+                      for stage, h in _histograms.items()}
+        counters = dict(_counters)
+
+    lines = ["# HELP jpp_stage_seconds Time taken by each stage of a grade.", "# TYPE jpp_stage_seconds histogram"]
+    for stage in sorted(histograms):
+        histogram = histograms[stage]
+        cumulative = 0
+        for bound, amount in zip(LATENCY_BUCKETS, histogram["buckets"]):
+            cumulative += amount
+            lines.append(f"jpp_stage_seconds_bucket{_labels([('stage', stage), ('le', bound)])} {cumulative}")
+        lines.append(f"jpp_stage_seconds_bucket{_labels([('stage', stage), ('le', '+Inf')])} {histogram['count']}")
+        lines.append(f"jpp_stage_seconds_sum{_labels([('stage', stage)])} {histogram['sum']}")
+        lines.append(f"jpp_stage_seconds_count{_labels([('stage', stage)])} {histogram['count']}")
+
+    for name in sorted(set(COUNTERS) | {name for name, _ in counters}):
+        lines.append(f"# HELP jpp_{name}_total {COUNTERS.get(name, name)}")
+        lines.append(f"# TYPE jpp_{name}_total counter")
+        for (counter, labels), amount in sorted(counters.items()):
+            if counter == name:
+                lines.append(f"jpp_{name}_total{_labels(labels)} {amount}")
+    return "\n".join(lines) + "\n"
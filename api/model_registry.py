@@ -0,0 +1,120 @@
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+from settings import SELECTED_MODEL, PRELOADED_MODELS, MODEL_POOL_SIZE, WARM_UP_MODELS, ASR_BACKEND
+from asr_backends import get_backend
+from metrics import timed
+
+"""
+Process-wide registry of loaded speech recognition models (see asr_backends).
+Loading a model costs seconds of disk reads and torch setup, so every model is loaded once per process
+and kept in a small pool. Each grade checks an instance out of the pool and returns it when done, so
+concurrent grades neither share one instance nor reload the model.
+"""
+
+class ModelPool():
+    """
+    Holds up to `size` instances of a single model of one backend.
+    Instances are loaded lazily the first time the pool runs dry, after that callers wait for one to be returned.
+    """
+    def __init__(self, name, size, backend=ASR_BACKEND):
+        self._name = name
+        self._backend = get_backend(backend)
+        self._size = max(1, size)
+        self._idle = queue.LifoQueue()
+        self._loaded = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        print(f"Loading {self._backend.name} model '{self._name}' ({self._loaded}/{self._size})")
+        return self._backend.load(self._name)
+
+    def acquire(self):
+        """Returns an idle model instance, loading a new one if the pool is not full yet."""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_load = self._loaded < self._size
+            if can_load:
+                self._loaded += 1
+
+        if not can_load:
+            return self._idle.get()
+
+        try:
+            return self._load()
+        except Exception:
+            with self._lock:
+                self._loaded -= 1
+            raise
+
+    def release(self, model):
+        """Returns a model instance to the pool."""
+        self._idle.put(model)
+
+    @contextmanager
+    def checkout(self):
+        """Context manager that lends out a model instance for the duration of the block.
+        The wait for an instance (and its loading, the first time) is recorded under the "whisper_model" stage."""
+        with timed("whisper_model"):
+            model = self.acquire()
+        try:
+            yield model
+        finally:
+            self.release(model)
+
+    def fill(self, warm_up=False):
+        """Loads instances until the pool is full. Optionally runs one throwaway inference on each."""
+        models = []
+        while True:
+            with self._lock:
+                if self._loaded >= self._size:
+                    break
+                self._loaded += 1
+            try:
+                models.append(self._load())
+            except Exception:
+                with self._lock:
+                    self._loaded -= 1
+                raise
+
+        for model in models:
+            if warm_up:
+                self._backend.warm_up(model)
+            self.release(model)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(name=SELECTED_MODEL, size=MODEL_POOL_SIZE, backend=ASR_BACKEND):
+    """Returns the process-wide pool for the given model name and backend, creating it on first use.
+    size only matters the first time a pool is created."""
+    with _pools_lock:
+        pool = _pools.get((backend, name))
+        if pool is None:
+            if not _pools and backend == "whisper":
+                limit_torch_threads(size)
+            pool = ModelPool(name, size, backend)
+            _pools[(backend, name)] = pool
+    return pool
+
+def preload_models(names=None, warm_up=WARM_UP_MODELS, size=MODEL_POOL_SIZE, backend=ASR_BACKEND):
+    """Loads (and optionally warms up) every configured model so the first grade doesn't pay for it."""
+    if names is None:
+        names = PRELOADED_MODELS
+    for name in names:
+        get_pool(name, size, backend).fill(warm_up=warm_up)
+
+def limit_torch_threads(concurrency):
+    """Splits the cpu cores between the given number of inferences that can run at once.
+    Otherwise every inference tries to use every core and they slow each other down."""
+    if concurrency <= 1 or ASR_BACKEND != "whisper":
+        return
+    import torch
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // concurrency))
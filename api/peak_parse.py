@@ -1,65 +1,70 @@
-import librosa
-import librosa.display
 import soundfile as sf
 
+import math
 import scipy
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
-from matplotlib.ticker import FormatStrFormatter
 from utilities import vowels, skip, data
+from settings import SAMPLING_RATE, SEGMENTATION_MODE, ENVELOPE_HOP
+from front_end import SpectralFrontEnd
 
 vowels = ['あ', 'い', 'う', 'え', 'お', 'ん']
 skip = ['ゃ', 'ゅ', 'ょ']
 
 
+def rectified_envelope(signal, hop):
+    """Returns the mean of the positive half of the signal over each block of hop samples (the last block may be shorter)."""
+    rectified = np.maximum(signal, 0)
+    if hop == 1:
+        return rectified
+    starts = np.arange(0, len(rectified), hop)
+    counts = np.minimum(hop, len(rectified) - starts)
+    return np.add.reduceat(rectified, starts) / counts
+
+def segment_minima(curve, peaks):
+    """Given a curve and the sorted indexes of its peaks, returns the index of the lowest point between each pair
+    of neighbouring peaks (the first one, on ties). All the segments are reduced together, without a loop."""
+    if len(peaks) < 2:
+        return np.array([], dtype=int)
+    lengths = np.diff(peaks)
+    segments = curve[peaks[0]:peaks[-1]]
+    minima = np.minimum.reduceat(segments, peaks[:-1] - peaks[0])
+    segment_ids = np.repeat(np.arange(len(lengths)), lengths)
+    at_minimum = np.flatnonzero(segments == minima[segment_ids])
+    _, first = np.unique(segment_ids[at_minimum], return_index=True)
+    return at_minimum[first] + peaks[0]
+
+
 class PeakParse():
     """
-    Takes the file of an audio file and makes a waveform.
+    Takes an audio file (or an already decoded signal, or a SpectralFrontEnd) and makes a waveform.
     Guassian filters the curve to find the peaks and dips of that curve.
     Can separate the audio file into syllables and plot the graph. 
     """
     # def __init__(self, dir, file, furigana, mora):
-    def __init__(self, file, furigana, mora):    
+    def __init__(self, file, furigana, mora, sampling_rate=SAMPLING_RATE):
         # Create the path and find the word
         self._furigana = furigana
         self._mora = mora
         
-        # Load the waveform
-        self._original, self._sampling_rate = librosa.load(file)
-        
-        # Voice Isolate
-        S_full, phase = librosa.magphase(librosa.stft(self._original))
-        S_filter = librosa.decompose.nn_filter(S_full,
-                                       aggregate=np.median,
-                                       metric='cosine',
-                                       width=int(librosa.time_to_frames(.1, sr=self._sampling_rate)))
-        S_filter = np.minimum(S_full, S_filter)
-        margin_v = 10
-        power = 2
-        mask_v = librosa.util.softmask(S_full - S_filter,
-                                    margin_v * S_filter,
-                                    power=power)
-
-        S_foreground = mask_v * S_full
-        new_y = librosa.istft(S_foreground*phase)
-
-        # Trim the silence from the beginning and end
-        self._trimmed, self._index = librosa.effects.trim(new_y, top_db=40)
-        self._original = self._original[self._index[0]: self._index[1]]
-
-        # Alter the wave_form's data
-        self._waveform = np.array(self._trimmed, copy=True)
-        self._waveform[self._waveform < 0] = 0
-        
-        # Get the time values of each point on the waveform
-        self._dur = librosa.get_duration(y=self._waveform)
-        self._time = np.linspace(start=0, stop=self._dur, num=self._waveform.shape[0])
+        # Run the shared spectral analysis (load, voice isolation, trim), unless we were handed one already
+        if isinstance(file, SpectralFrontEnd):
+            self._front_end = file
+        else:
+            self._front_end = SpectralFrontEnd(file, sampling_rate)
+        self._sampling_rate = self._front_end.sampling_rate
+        self._trimmed, self._index = self._front_end.trimmed, self._front_end.index
+        self._original = self._front_end.trimmed_original
+
+        # Rectify the waveform and average it down to one value per ENVELOPE_HOP samples.
+        # The syllable rate is a few Hz, so the envelope loses nothing we look for at ~170 Hz,
+        # and the gaussian (its sigma scaled down to match) runs over a hundred times fewer points.
+        self._envelope_hop = max(int(ENVELOPE_HOP), 1)
+        envelope = rectified_envelope(self._trimmed, self._envelope_hop)
 
         # Calculate the peaks from the gaussian filtered data
-        self._gauss_filt = scipy.ndimage.gaussian_filter1d(self._waveform, sigma=500)
-        max = np.max(self._gauss_filt)
-        self._gauss_filt /= max
+        self._gauss_filt = scipy.ndimage.gaussian_filter1d(envelope, sigma=500 / self._envelope_hop)
+        gauss_max = np.max(self._gauss_filt)
+        self._gauss_filt /= gauss_max
 
         # Get the number of double vowels
         num_of_double_vowels = 0
@@ -72,22 +77,56 @@ class PeakParse():
 
         # The expected peaks we get are on for each mora minus the devoiced vowels and double vowels
         # We subtract one for /desu/ and by the number of souble vowels
-        # Then we repeatedly try lower peak_heights until we get the right amount of peaks
-        # There is the issue of getting more peaks than we want
+        expected_peaks = mora - 1 - num_of_double_vowels
+        if SEGMENTATION_MODE == "iterative":
+            self._peaks = self._find_peaks_iterative(expected_peaks, gauss_max)
+            self._dips = self._find_dips_iterative()
+        else:
+            self._peaks = self._find_peaks(expected_peaks, gauss_max)
+            self._dips = segment_minima(self._gauss_filt, self._peaks)
+
+        # peaks stay in envelope frames, dips are mapped back to samples of the trimmed signal for splitting.
+        self._dips = np.minimum(self._dips * self._envelope_hop + self._envelope_hop // 2, len(self._original)).astype(int)
+        self._splice_audio()
+
+    def _find_peaks(self, expected_peaks, gauss_max):
+        """
+        Finds every peak once and keeps the same ones the iterative search would have.
+        That search lowers peak_height from .005 in steps of .001 until enough peaks clear it, so it stops
+        at the first step below the height of the expected_peaks-th highest peak, and keeps every peak above that.
+        """
+        peaks, properties = scipy.signal.find_peaks(self._gauss_filt, height=0)
+        heights = properties["peak_heights"]
+        if expected_peaks < 1 or len(peaks) < expected_peaks:
+            # the search would have run out of steps and kept everything
+            return peaks if expected_peaks >= 1 else peaks[heights >= .005 / gauss_max]
+
+        kth_height = np.partition(heights, len(heights) - expected_peaks)[len(heights) - expected_peaks]
+        steps = max(math.ceil(round((.005 - kth_height * gauss_max) / .001, 9)), 0)
+        return peaks[heights >= (.005 - .001 * steps) / gauss_max]
+
+    def _find_peaks_iterative(self, expected_peaks, gauss_max):
+        """
+        The original search: repeatedly try lower peak_heights until we get the right amount of peaks.
+        There is the issue of getting more peaks than we want
+        """
         peak_height = .005
-        self._peaks, _ = scipy.signal.find_peaks(self._gauss_filt, height=(peak_height / max))
-        while len(self._peaks) < (mora - 1 - num_of_double_vowels):
-            if peak_height == 0:
+        peaks, _ = scipy.signal.find_peaks(self._gauss_filt, height=(peak_height / gauss_max))
+        while len(peaks) < expected_peaks:
+            if peak_height <= 0:
                 break
             peak_height -= .001
-            self._peaks, _ = scipy.signal.find_peaks(self._gauss_filt, height=(peak_height / max))
+            peaks, _ = scipy.signal.find_peaks(self._gauss_filt, height=(peak_height / gauss_max))
+        return peaks
 
-        # Calculate the dips
-        self._dips = []
+    def _find_dips_iterative(self):
+        """
+        The original dip search: the first point of the whole curve equal to the lowest point between each pair of peaks.
+        """
+        dips = []
         for i in range(len(self._peaks) - 1):
-            self._dips.append(np.where(self._gauss_filt == min(self._gauss_filt[self._peaks[i]:self._peaks[i+1]]))[0][0])
-        self._dips = np.array(self._dips)
-        self._splice_audio()
+            dips.append(np.where(self._gauss_filt == min(self._gauss_filt[self._peaks[i]:self._peaks[i+1]]))[0][0])
+        return np.array(dips)
 
     def _splice_audio(self):
         """
@@ -111,7 +150,7 @@ class PeakParse():
                         i += 1
 
                     # Find the duration that we should split the clip by
-                    bad_dip_end = len(self._gauss_filt) if dip_indexer - 1 >= len(self._dips) else self._dips[dip_indexer - 1]
+                    bad_dip_end = len(self._original) if dip_indexer - 1 >= len(self._dips) else self._dips[dip_indexer - 1]
                     bad_dip_start = 0 if dip_indexer - 2 < 0 else self._dips[dip_indexer - 2]
                     mora_dur = (bad_dip_end - bad_dip_start) // (vowel_chain + 1)
 
@@ -124,58 +163,47 @@ class PeakParse():
         # Every syllable besides desu has been cut
         if len(self._dips) + 1 == self._mora - 1:
             desu = self._dips[-1]
-            half_point = desu + ((self._waveform.size - desu) // 2)
+            half_point = desu + ((len(self._original) - desu) // 2)
             self._dips = np.append(self._dips, [half_point])
 
+    def get_clip_bounds(self):
+        """
+        Returns the (start, end) sample indexes of each split clip within the trimmed signal.
+        """
+        bounds = []
+        t1 = 0
+        for end_timestamp in self._dips:
+            bounds.append((t1, int(end_timestamp)))
+            t1 = int(end_timestamp)
+        bounds.append((t1, len(self._original)))
+        return bounds
+
     def parse_clips(self):
         """
         Returns the clips of audio that were split.
+        Each clip is a view into the trimmed signal, no samples are copied.
         """
         clips = []
-        t1 = 0
-        for i, end_timestamp in enumerate(self._dips):
+        for start, end in self.get_clip_bounds():
             # export_filename = "output/" + self._furigana + "_gp" + str(i) + ".wav"
-            newAudio = self._original[t1:end_timestamp]
+            newAudio = self._original[start:end]
             clips.append(newAudio)
             # sf.write(export_filename, newAudio, self._sampling_rate)
-            t1 = end_timestamp
-        
-        # export_filename = "output/" + self._furigana + "_gp" + str(self._mora - 1) + ".wav"
-        newAudio = self._original[t1:]
-        clips.append(newAudio)
-        # sf.write(export_filename, newAudio, self._sampling_rate)
         return clips
+
+    def get_mora_pitches(self):
+        """
+        Returns the pitch of each split clip in midi, sliced out of the shared pitch track.
+        """
+        return self._front_end.mora_pitches(self.get_clip_bounds())
     
     def plot_waves(self):
         """
-        Plots all the waves and graphs. For research purposes. 
-        """
-        gs = gridspec.GridSpec(2, 2)
-
-        fig = plt.figure(figsize=(8.8, 6))
-        ax1 = fig.add_subplot(gs[0, 0]) # row 0, col 0
-        librosa.display.waveshow(self._original, sr=self._sampling_rate, ax=ax1, color="#1f77b4")
-        ax1.xaxis.set_major_formatter(FormatStrFormatter('%g'))
-        ax1.set_title("Waveform")
-        plt.xlabel("Time")
-        plt.ylabel("Amplitude")
-
-        ax2 = fig.add_subplot(gs[0, 1]) # row 0, col 1
-        ax2.plot(self._time, self._waveform)
-        ax2.set_title("Altered Data")
-        plt.xlabel("Time")
-        plt.ylabel("Amplitude")
-
-        ax3 = fig.add_subplot(gs[1, :]) # row 1, span all columns
-        ax3.plot(self._time, self._gauss_filt, label='Gaussian Filter')
-        ax3.plot(self._time[self._peaks], self._gauss_filt[self._peaks], "x", label='peaks')
-        ax3.plot(self._time[self._dips], self._gauss_filt[self._dips], "x", label='dips')
-        ax3.legend()
-        plt.xlabel("Time")
-        plt.ylabel("Amplitude")
-
-        plt.savefig("output.jpg")
-        # plt.show()
+        Plots all the waves and graphs to output.jpg. For research purposes. 
+        """
+        from plotting import plot_peak_parse
+        plot_peak_parse(self._original, self._trimmed, self._gauss_filt, self._peaks, self._dips,
+                        self._envelope_hop, self._sampling_rate)
 
     def get_original_clip_timestamps(self):
         """
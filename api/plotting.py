@@ -0,0 +1,76 @@
+import numpy as np
+
+"""
+Plots for research and debugging.
+matplotlib (and librosa.display, which pulls it in) are only imported once something is actually plotted,
+so the api process, which never plots, doesn't pay for loading them.
+"""
+
+def plot_peak_parse(original, trimmed, gauss_filt, peaks, dips, envelope_hop, sampling_rate, filename="output.jpg"):
+    """Plots the waveform, the rectified waveform and the smoothed envelope with its peaks and dips
+    (see PeakParse.plot_waves) and saves the figure to filename."""
+    import librosa.display
+    import matplotlib.pyplot as plt
+    import matplotlib.gridspec as gridspec
+    from matplotlib.ticker import FormatStrFormatter
+
+    gs = gridspec.GridSpec(2, 2)
+
+    fig = plt.figure(figsize=(8.8, 6))
+    ax1 = fig.add_subplot(gs[0, 0]) # row 0, col 0
+    librosa.display.waveshow(original, sr=sampling_rate, ax=ax1, color="#1f77b4")
+    ax1.xaxis.set_major_formatter(FormatStrFormatter('%g'))
+    ax1.set_title("Waveform")
+    plt.xlabel("Time")
+    plt.ylabel("Amplitude")
+
+    # time values only exist for the plot
+    waveform = np.maximum(trimmed, 0)
+    time = np.arange(len(waveform)) / sampling_rate
+    envelope_time = (np.arange(len(gauss_filt)) * envelope_hop + envelope_hop // 2) / sampling_rate
+    dip_frames = np.minimum(dips // envelope_hop, len(gauss_filt) - 1)
+
+    ax2 = fig.add_subplot(gs[0, 1]) # row 0, col 1
+    ax2.plot(time, waveform)
+    ax2.set_title("Altered Data")
+    plt.xlabel("Time")
+    plt.ylabel("Amplitude")
+
+    ax3 = fig.add_subplot(gs[1, :]) # row 1, span all columns
+    ax3.plot(envelope_time, gauss_filt, label='Gaussian Filter')
+    ax3.plot(envelope_time[peaks], gauss_filt[peaks], "x", label='peaks')
+    ax3.plot(time[np.minimum(dips, len(time) - 1)], gauss_filt[dip_frames], "x", label='dips')
+    ax3.legend()
+    plt.xlabel("Time")
+    plt.ylabel("Amplitude")
+
+    plt.savefig(filename)
+    # plt.show()
+
+def plot_pitches(pitches):
+    """Given a set of pitches, plot them equally spaced in time to see a visualization of the pitch over time."""
+    import matplotlib.pyplot as plt
+
+    time_axis = np.arange(len(pitches))
+    plt.scatter(time_axis, pitches)
+
+    plt.ylabel("Pitch")
+    plt.title("Pitch vs. Time")
+
+    plt.show()
+
+def plot_divisions(original, sampling_rate, times):
+    """Plots a waveform with a line at each of the given end timestamps (see DurationParse.get_divisions)."""
+    import librosa.display
+    import matplotlib.pyplot as plt
+
+    plt.figure()
+    librosa.display.waveshow(original, sr=sampling_rate, label='waveform')
+    plt.vlines(x = times, ymin = -.15, ymax = .15,
+        colors = 'purple',
+        ls='--',
+        label = 'end timestamp')
+    plt.legend()
+    plt.xlabel("Time")
+    plt.ylabel("Amplitude")
+    plt.show()
@@ -1,52 +1,230 @@
-import whisper # consider local import to cut down on import time.
-from settings import SELECTED_MODEL, CORRECT_LANGUAGE_WEIGHT, CORRECT_TEXT_WEIGHT
+import math
+from difflib import SequenceMatcher
+from contextlib import contextmanager
+
+import numpy as np
+import librosa
+from settings import CORRECT_LANGUAGE_WEIGHT, CORRECT_TEXT_WEIGHT, SAMPLING_RATE, WHISPER_BATCH_SIZE
+from settings import WHISPER_INPUT, WHISPER_MIN_AUDIO_CTX, WHISPER_CROP_PADDING, PRONUNCIATION_SCORING, DISTRACTOR_COUNT
+from asr_backends import check_with_backend
+from lexicon import get_lexicon
+from metrics import timed
 import utilities
 
-def preliminary_pronunciation_check(filename, expected_text):
+# whisper and torch are imported inside the functions that use them, so importing this module
+# (and everything that imports it, like the api) doesn't wait on torch. these match whisper.audio.
+WHISPER_SAMPLE_RATE = 16000
+WHISPER_HOP_LENGTH = 160
+
+def load_whisper_audio(filename, sampling_rate=SAMPLING_RATE):
+    """Returns the audio at the 16 kHz rate whisper expects.
+    Accepts either a path for whisper to load, or an already decoded signal at sampling_rate."""
+    with timed("whisper_load_audio"):
+        if isinstance(filename, str):
+            import whisper
+            return whisper.load_audio(filename)
+        return librosa.resample(filename, orig_sr=sampling_rate, target_sr=WHISPER_SAMPLE_RATE)
+
+def crop_to_region(audio, region, sampling_rate=SAMPLING_RATE):
+    """Given 16 kHz audio and the (start, end) samples of the voiced region at sampling_rate (ie. SpectralFrontEnd.index),
+    returns the voiced region with WHISPER_CROP_PADDING seconds of margin on either side."""
+    ratio = WHISPER_SAMPLE_RATE / sampling_rate
+    padding = int(WHISPER_CROP_PADDING * WHISPER_SAMPLE_RATE)
+    start = max(int(region[0] * ratio) - padding, 0)
+    end = min(int(math.ceil(region[1] * ratio)) + padding, len(audio))
+    return audio[start:end]
+
+def audio_context_length(audios, model):
+    """Returns how many encoder positions (two mel frames, 20 ms each) it takes to hold the longest of the audios,
+    never less than WHISPER_MIN_AUDIO_CTX and never more than the full 30 seconds the model was built for."""
+    longest = max(len(audio) for audio in audios)
+    n_ctx = math.ceil(longest / (2 * WHISPER_HOP_LENGTH))
+    return min(max(n_ctx, WHISPER_MIN_AUDIO_CTX), model.dims.n_audio_ctx)
+
+def encode_cropped(model, mel):
+    """Runs whisper's audio encoder over a mel spectrogram shorter than 30 seconds.
+    AudioEncoder.forward insists on the full 1500 positions, so this is the same forward pass
+    with the positional embedding cut to the length of the input."""
+    import torch.nn.functional as F
+
+    encoder = model.encoder
+    x = F.gelu(encoder.conv1(mel))
+    x = F.gelu(encoder.conv2(x))
+    x = x.permute(0, 2, 1)
+    x = (x + encoder.positional_embedding[:x.shape[1]]).to(x.dtype)
+    for block in encoder.blocks:
+        x = block(x)
+    return encoder.ln_post(x)
+
+@contextmanager
+def audio_context(model, n_ctx):
+    """Temporarily tells the model its audio context is n_ctx positions long.
+    detect_language and decode skip the encoder when they are handed features of shape (n_audio_ctx, n_audio_state),
+    so this is how already encoded, shorter features get through them. Only safe on a model checked out of the pool."""
+    full_ctx = model.dims.n_audio_ctx
+    model.dims.n_audio_ctx = n_ctx
+    try:
+        yield
+    finally:
+        model.dims.n_audio_ctx = full_ctx
+
+def encode(model, audios):
+    """Runs whisper's audio encoder once over a batch of 16 kHz audios. Returns (features, n_ctx).
+    With WHISPER_INPUT = "padded" every audio is padded to 30 seconds like whisper.transcribe does.
+    With "cropped" the audios are only padded to the longest one of the batch (or WHISPER_MIN_AUDIO_CTX),
+    so the encoder works in proportion to the speech instead of 30 seconds of mostly silence.
+    n_ctx is the number of positions in the features, to go with audio_context."""
+    import whisper
+    import torch
+
+    with timed("whisper_encode"):
+        if WHISPER_INPUT == "cropped":
+            n_ctx = audio_context_length(audios, model)
+            n_samples = n_ctx * 2 * WHISPER_HOP_LENGTH
+            audios = [np.pad(audio[:n_samples], (0, max(n_samples - len(audio), 0))) for audio in audios]
+        else:
+            n_ctx = model.dims.n_audio_ctx
+            audios = [whisper.pad_or_trim(audio) for audio in audios]
+        mel = torch.stack([whisper.log_mel_spectrogram(audio, n_mels=model.dims.n_mels) for audio in audios]).to(model.device)
+
+        with torch.no_grad():
+            if WHISPER_INPUT == "cropped":
+                return encode_cropped(model, mel), n_ctx
+            return model.embed_audio(mel), n_ctx
+
+def transcribe(model, audios):
+    """Runs language detection and free decoding over a batch of 16 kHz audios. Returns a list of (language, text).
+    The audio is encoded once and the features are shared by detect_language and decode."""
+    import whisper
+
+    features, n_ctx = encode(model, audios)
+    # timestamps are meaningless on a cropped context, and skipping them saves decoding steps.
+    # half precision only on a gpu: on a cpu whisper would cast the features to fp16, which is slow or unsupported.
+    options = whisper.DecodingOptions(without_timestamps=(WHISPER_INPUT == "cropped"), fp16=(model.device.type == "cuda"))
+    with timed("whisper_decode"), audio_context(model, n_ctx):
+        _, probs = model.detect_language(features)
+        results = whisper.decode(model, features, options)
+
+    return [(max(language_probs, key=language_probs.get), result.text) for language_probs, result in zip(probs, results)]
+
+def distractor_readings(expected_text, count=DISTRACTOR_COUNT):
+    """Returns the count known readings that look the most like expected_text (and aren't it),
+    the competing answers forced scoring weighs the expected text against."""
+    others = [reading for reading in get_lexicon().readings() if reading != expected_text]
+    others.sort(key=lambda reading: -SequenceMatcher(None, reading, expected_text).ratio())
+    return others[:count]
+
+def forced_scores(model, features, expected_texts):
+    """Scores how likely each recording is to say its expected text, with teacher forcing instead of decoding.
+    The expected text and its distractor_readings are fed to the decoder as if whisper had transcribed them,
+    and one forward pass gives the log-likelihood of every one of their tokens. Returns, for each recording,
+    the share of the probability (over the candidates, by mean token log-likelihood) that goes to the expected text."""
+    import whisper
+    import torch
+
+    tokenizer = whisper.tokenizer.get_tokenizer(model.is_multilingual, num_languages=model.num_languages,
+                                                language="ja", task="transcribe")
+    prefix = list(tokenizer.sot_sequence_including_notimestamps)
+    scores = []
+
+    for audio_features, expected_text in zip(features, expected_texts):
+        candidates = [expected_text] + distractor_readings(expected_text)
+        sequences = [prefix + tokenizer.encode(text) + [tokenizer.eot] for text in candidates]
+        length = max(len(sequence) for sequence in sequences)
+        tokens = torch.tensor([sequence + [tokenizer.eot] * (length - len(sequence)) for sequence in sequences], device=model.device)
+
+        with torch.no_grad():
+            logits = model.decoder(tokens, audio_features.unsqueeze(0).expand(len(candidates), -1, -1))
+        log_probs = torch.log_softmax(logits.float(), dim=-1)[:, :-1]
+        token_log_probs = log_probs.gather(-1, tokens[:, 1:].unsqueeze(-1)).squeeze(-1)
+
+        # only the text and its end of transcript count, not the prefix or the padding after eot.
+        positions = torch.arange(length - 1, device=model.device)
+        ends = torch.tensor([len(sequence) - 1 for sequence in sequences], device=model.device)
+        scored = (positions >= len(prefix) - 1) & (positions < ends.unsqueeze(1))
+        mean_log_probs = (token_log_probs * scored).sum(dim=1) / scored.sum(dim=1)
+
+        scores.append(torch.softmax(mean_log_probs, dim=0)[0].item())
+    return scores
+
+def check_audios(model, audios, expected_texts):
+    """Returns the coefficient of each of a batch of 16 kHz audios, with the PRONUNCIATION_SCORING method."""
+    if PRONUNCIATION_SCORING == "forced":
+        features, n_ctx = encode(model, audios)
+        with timed("whisper_decode"):
+            with audio_context(model, n_ctx):
+                _, probs = model.detect_language(features)
+            posteriors = forced_scores(model, features, expected_texts)
+        for language_probs, posterior in zip(probs, posteriors):
+            print(f"Japanese probability: {language_probs['ja']}, expected text posterior: {posterior}")
+        return [score_forced(language_probs, posterior) for language_probs, posterior in zip(probs, posteriors)]
+
+    coefficients = []
+    for (detected_language, text), expected_text in zip(transcribe(model, audios), expected_texts):
+        print(f"Detected language: {detected_language}")
+        # print the recognized text
+        print(text)
+        coefficients.append(score_transcription(detected_language, text, expected_text))
+    return coefficients
+
+def preliminary_pronunciation_check(filename, expected_text, region=None):
     """Uses whisper to check to see if the base level of pronunciation is good enough to be understood by Speech-to-Text AI.
     Will go through a series of checks to see if some standard expectations are met.
     Currently, those checks are making sure the model detects the spoken language as Japanese, and that the words are transcribed correctly.
-    Note that filename and expected_text should be the full phrase, not the individual segmented phrases!"""
+    Note that filename and expected_text should be the full phrase, not the individual segmented phrases!
+    filename may also be the decoded signal itself, at SAMPLING_RATE.
+    region is the (start, end) samples of the voiced part of the signal. With WHISPER_INPUT = "cropped", only that part is transcribed."""
 
-    # grade assigned by whisper. starts at 0.
-    grade = 0
+    # load audio (padding it happens in encode)
+    audio = load_whisper_audio(filename)
+    if region is not None and WHISPER_INPUT == "cropped":
+        audio = crop_to_region(audio, region)
 
-    model = whisper.load_model(SELECTED_MODEL)
+    # borrow an already loaded model instance of the ASR_BACKEND from the process-wide pool
+    return check_with_backend([audio], [expected_text])[0]
 
-    # load audio and pad/trim it to fit 30 seconds
-    audio = whisper.load_audio(filename)
-    audio = whisper.pad_or_trim(audio)
+def preliminary_pronunciation_check_batch(filenames, expected_texts, regions=None):
+    """Batched version of preliminary_pronunciation_check. Takes parallel lists of audio (paths or decoded signals)
+    and expected texts (and optionally voiced regions), and returns the list of coefficients.
+    Language detection and decoding run once per WHISPER_BATCH_SIZE recordings instead of once per recording."""
+    coefficients = []
+    audios = [load_whisper_audio(filename) for filename in filenames]
+    if regions is not None and WHISPER_INPUT == "cropped":
+        audios = [audio if region is None else crop_to_region(audio, region) for audio, region in zip(audios, regions)]
 
-    # make log-Mel spectrogram and move to the same device as the model
-    mel = whisper.log_mel_spectrogram(audio).to(model.device)
+    for start in range(0, len(audios), WHISPER_BATCH_SIZE):
+        chunk = audios[start:start + WHISPER_BATCH_SIZE]
+        texts = expected_texts[start:start + WHISPER_BATCH_SIZE]
 
-    # detect the spoken language
-    _, probs = model.detect_language(mel)
-    detected_language = max(probs, key=probs.get)
-    print(f"Detected language: {detected_language}")
+        coefficients += check_with_backend(chunk, texts)
 
-    # decode the audio
-    options = whisper.DecodingOptions()
-    result = whisper.decode(model, mel, options)
+    return coefficients
 
-    # print the recognized text
-    print(result.text)
+def score_forced(language_probs, posterior):
+    """Given whisper's language probabilities and the forced_scores posterior of the expected text,
+    returns a continuous coefficient between 0 and 1."""
+    return CORRECT_LANGUAGE_WEIGHT * language_probs.get("ja", 0) + CORRECT_TEXT_WEIGHT * posterior
+
+def score_transcription(detected_language, text, expected_text):
+    """Given the language and text whisper detected, returns how well they match the expected text, between 0 and 1."""
+    # grade assigned by whisper. starts at 0.
+    grade = 0
 
     # start grading.
     if detected_language == "ja":
         grade += CORRECT_LANGUAGE_WEIGHT
         # result text will only ever be correct if in correct language, so nest.
-        if result.text == expected_text:
+        if text == expected_text:
             grade += CORRECT_TEXT_WEIGHT
         else:
             # japanese detected, incorrect word detected.
-            result_hiragana = utilities.text_to_hiragana(result.text)
+            result_hiragana = utilities.text_to_hiragana(text)
             expected_hiragana = utilities.text_to_hiragana(expected_text)
 
             grade += CORRECT_TEXT_WEIGHT * utilities.compare_hiragana_strings(result_hiragana, expected_hiragana)
     else:
-        result_romaji = utilities.text_to_romaji(result.text)
+        result_romaji = utilities.text_to_romaji(text)
         expected_romaji = utilities.text_to_romaji(expected_text)
         grade += CORRECT_LANGUAGE_WEIGHT * utilities.compare_romaji_strings(result_romaji, expected_romaji)
 
-    return grade
\ No newline at end of file
+    return grade
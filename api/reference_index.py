@@ -0,0 +1,195 @@
+import os
+import json
+import hashlib
+import threading
+
+import numpy as np
+from settings import REFERENCE_AUDIO_DIRECTORIES, REFERENCE_INDEX_DIRECTORY, HOP_LENGTH, MINIMUM_DELTA
+from front_end import SpectralFrontEnd
+from peak_parse import PeakParse
+from duration_parse import DurationParse
+from analysis import devoiced_check
+from lexicon import get_lexicon
+from utilities import split_word
+
+"""
+Precomputed features of the native speaker reference recordings.
+Run this file to (re)build the index:
+    python reference_index.py
+Every reference recording is analysed once, offline, and its features are stored as flat numpy arrays:
+    contours.npy    f0 of every frame, in midi (nan where unvoiced)
+    energy.npy      rms of every frame, scaled so each word's loudest frame is 1
+    boundaries.npy  frame index (within the word) where each mora starts, plus the end of the last mora
+    mora.npy        (pitch in midi, duration in seconds) of each mora
+index.json says which slice of each array belongs to which word. The arrays are memory-mapped when
+loaded, so looking a word up costs no decoding and no copying.
+"""
+
+INDEX_FILE = "index.json"
+ARRAY_FILES = ["contours", "energy", "boundaries", "mora"]
+
+def known_readings():
+    """Returns {kanji: (reading, accent_type)} for every word we know the reading of."""
+    return {entry["kanji"]: (entry["reading"], entry["accent_type"]) for entry in get_lexicon()}
+
+def extract_features(path, reading):
+    """Analyses one reference recording. Returns a dict of its features and how it was split into mora."""
+    word_array, mora_length = split_word(reading)
+    front_end = SpectralFrontEnd(path)
+
+    gp = PeakParse(front_end, reading, mora_length)
+    bounds = gp.get_clip_bounds()
+    split = "peak_parse"
+    if len(bounds) != mora_length:
+        # the reference has to be usable even when peak hunting fails, so fall back to equal durations.
+        divisions = DurationParse(reading, mora_length, front_end).get_divisions()
+        ends = [int(round(end * front_end.sampling_rate)) for end in divisions]
+        ends[-1] = len(front_end.trimmed_original)
+        bounds = list(zip([0] + ends[:-1], ends))
+        split = "duration"
+
+    contour, energy = front_end.contour_features()
+    first, _ = front_end.frames(0, len(front_end.trimmed_original))
+
+    frame_bounds = [front_end.frames(start, end) for start, end in bounds]
+    boundaries = [start - first for start, _ in frame_bounds] + [frame_bounds[-1][1] - first]
+
+    mora_pitches = front_end.mora_pitches(bounds)
+    durations = [(end - start) / front_end.sampling_rate for start, end in bounds]
+
+    return {
+        "contours": contour,
+        "energy": energy,
+        "boundaries": np.array(boundaries, dtype=np.int32),
+        "mora": np.column_stack((mora_pitches, durations)).astype(np.float32),
+        "split": split,
+        "mora_array": word_array,
+    }
+
+def build_reference_index(audio_directories=REFERENCE_AUDIO_DIRECTORIES, output_directory=REFERENCE_INDEX_DIRECTORY):
+    """Analyses every reference recording we know the reading of and writes the index to output_directory."""
+    readings = known_readings()
+    arrays = {name: [] for name in ARRAY_FILES}
+    offsets = {name: 0 for name in ARRAY_FILES}
+    words = {}
+
+    for directory in audio_directories:
+        for name in sorted(os.listdir(directory)):
+            kanji, extension = os.path.splitext(name)
+            if extension != ".wav" or kanji in words:
+                continue
+            if kanji not in readings:
+                print(f"Skipping {name}: reading unknown")
+                continue
+
+            reading, accent_type = readings[kanji]
+            features = extract_features(os.path.join(directory, name), reading)
+
+            entry = {"reading": reading, "accent_type": accent_type, "split": features["split"],
+                     "mora_array": features["mora_array"], "source": os.path.join(directory, name)}
+            for array_name in ARRAY_FILES:
+                values = features[array_name]
+                entry[array_name] = [offsets[array_name], offsets[array_name] + len(values)]
+                offsets[array_name] += len(values)
+                arrays[array_name].append(values)
+            words[kanji] = entry
+            print(f"Indexed {kanji} ({reading}, split by {features['split']})")
+
+    os.makedirs(output_directory, exist_ok=True)
+    empty = {"contours": np.zeros(0, np.float32), "energy": np.zeros(0, np.float32),
+             "boundaries": np.zeros(0, np.int32), "mora": np.zeros((0, 2), np.float32)}
+    for array_name in ARRAY_FILES:
+        values = np.concatenate(arrays[array_name]) if arrays[array_name] else empty[array_name]
+        np.save(os.path.join(output_directory, array_name + ".npy"), values)
+
+    with open(os.path.join(output_directory, INDEX_FILE), "w", encoding="utf-8") as f:
+        json.dump({"hop_length": HOP_LENGTH, "words": words}, f, ensure_ascii=False, indent=1)
+
+    print(f"Wrote {len(words)} reference words to {output_directory}")
+
+
+class ReferenceIndex():
+    """
+    Loads a reference index written by build_reference_index, with its arrays memory-mapped.
+    Words can be looked up by kanji or by reading.
+    """
+    def __init__(self, directory=REFERENCE_INDEX_DIRECTORY):
+        with open(os.path.join(directory, INDEX_FILE), encoding="utf-8") as f:
+            index = json.load(f)
+        self._words = index["words"]
+        self._arrays = {name: np.load(os.path.join(directory, name + ".npy"), mmap_mode="r") for name in ARRAY_FILES}
+
+        # a hash of every file of the index, so anything keyed on grades (ie. the result cache) can tell a rebuilt index apart.
+        digest = hashlib.sha256()
+        for name in [INDEX_FILE] + [name + ".npy" for name in ARRAY_FILES]:
+            with open(os.path.join(directory, name), "rb") as f:
+                digest.update(f.read())
+        self.fingerprint = digest.hexdigest()
+
+        self._by_reading = {}
+        for kanji, entry in self._words.items():
+            self._by_reading.setdefault(entry["reading"], []).append(kanji)
+
+    def __contains__(self, word):
+        return word in self._words or word in self._by_reading
+
+    def lookup(self, word, accent_type=None):
+        """Given a kanji or a reading, returns a dict of the reference features (contours, energy, boundaries, mora)
+        as read-only views, plus the reading and accent_type. Returns None if there is no matching reference.
+        When several words share a reading (ie. 日本 and 二本), accent_type picks between them, preferring an exact match.
+        Without an accent_type, a reading shared by words with different (or unknown) accent types has no reference."""
+        if word in self._words:
+            candidates = [word]
+        else:
+            candidates = self._by_reading.get(word, [])
+            if accent_type is not None:
+                candidates = [kanji for kanji in candidates if self._words[kanji]["accent_type"] in (accent_type, None)]
+            elif len({self._words[kanji]["accent_type"] for kanji in candidates}) > 1:
+                return None
+            candidates = sorted(candidates, key=lambda kanji: self._words[kanji]["accent_type"] != accent_type)
+        if not candidates:
+            return None
+
+        kanji = candidates[0]
+        entry = self._words[kanji]
+        reference = {"kanji": kanji, "reading": entry["reading"], "accent_type": entry["accent_type"], "split": entry["split"]}
+        for name in ARRAY_FILES:
+            start, end = entry[name]
+            reference[name] = self._arrays[name][start:end]
+        return reference
+
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_reference_index():
+    """Returns the process-wide reference index, loading it on first use. Returns None if it hasn't been built."""
+    global _index
+    with _index_lock:
+        if _index is None and os.path.isfile(os.path.join(REFERENCE_INDEX_DIRECTORY, INDEX_FILE)):
+            _index = ReferenceIndex(REFERENCE_INDEX_DIRECTORY)
+    return _index
+
+def compare_to_reference(pitches, word, reference):
+    """Given the pitch of each mora (midi), the parallel mora array, and a reference from ReferenceIndex.lookup,
+    returns between 0 and 1 how closely the shape of the pitch pattern follows the native speaker.
+    Both patterns are centered on their own median first, so only the shape matters, not the speaker's register.
+    Differences smaller than MINIMUM_DELTA, and devoiced mora, are not held against the student."""
+    reference_pitches = np.asarray(reference["mora"][:, 0], dtype=float)
+    pitches = np.asarray(pitches, dtype=float)
+    if len(pitches) != len(reference_pitches):
+        return None
+
+    usable = np.isfinite(pitches) & np.isfinite(reference_pitches)
+    usable &= np.array([not devoiced_check(mora) for mora in word])
+    if not usable.any():
+        return None
+
+    student = pitches[usable] - np.median(pitches[usable])
+    native = reference_pitches[usable] - np.median(reference_pitches[usable])
+    difference = np.maximum(np.abs(student - native) - MINIMUM_DELTA, 0)
+    return float(np.mean(1 / (1 + difference)))
+
+
+if __name__ == "__main__":
+    build_reference_index()
@@ -0,0 +1,187 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import settings
+from settings import RESULT_CACHE_SIZE, RESULT_CACHE_DIRECTORY, RESULT_CACHE_DISK_ENTRIES
+from metrics import count
+from catalog import get_catalog
+from reference_index import get_reference_index
+
+"""
+Cache of finished grades, so a recording that was already graded (ie. a student resubmitting the same take,
+or a load test replaying its fixtures) doesn't go through decoding, analysis and whisper again.
+Results are keyed by a hash of the recording, the word, the accent type and everything else that can change a grade:
+the settings, the word lists (through the catalog version) and the reference index.
+A recording is looked up twice: by the bytes that were uploaded, which skips even decoding, and by its decoded samples,
+which also catches the same recording arriving encoded differently (ie. streamed in chunks).
+The most recently used RESULT_CACHE_SIZE results are kept in memory, and, with RESULT_CACHE_DIRECTORY set,
+on disk too, where they survive restarts and are shared by every worker process.
+"""
+
+# settings that only change how fast or how many grades run, never what grade comes out.
+UNFINGERPRINTED_SETTINGS = {
+    "PRELOADED_MODELS", "MODEL_POOL_SIZE", "WHISPER_BATCH_SIZE", "WARM_UP_MODELS", "KANA_CACHE_SIZE", "FFMPEG_POOL_SIZE",
+    "STARTUP_MODE", "SERVER_MODE", "WORKER_COUNT", "MAX_QUEUED_JOBS", "QUEUE_TIMEOUT", "BATCH_MAX_ITEMS",
+    "BATCH_DSP_WORKERS", "MAX_UPLOAD_BYTES", "MAX_STREAMS", "STREAM_TIMEOUT", "JOB_WORKERS", "JOB_QUEUE_SIZE", "JOB_RESULT_TTL",
+    "RESULT_CACHE_SIZE", "RESULT_CACHE_DIRECTORY", "RESULT_CACHE_DISK_ENTRIES",
+}
+
+_fingerprint = None
+
+def settings_fingerprint():
+    """Returns a hash of every setting that can change a grade."""
+    global _fingerprint
+    if _fingerprint is None:
+        values = {name: getattr(settings, name) for name in dir(settings)
+                  if name.isupper() and name not in UNFINGERPRINTED_SETTINGS}
+        _fingerprint = hashlib.sha256(json.dumps(values, sort_keys=True, default=repr).encode("utf-8")).hexdigest()
+    return _fingerprint
+
+def grading_fingerprint():
+    """Returns a hash of everything besides the recording and the word that can change a grade:
+    the settings, the word lists and the reference index (if one is built)."""
+    index = get_reference_index()
+    return hashlib.sha256(f"{settings_fingerprint()}|{get_catalog().version}|{None if index is None else index.fingerprint}"
+                          .encode("utf-8")).hexdigest()
+
+def cache_key(recording, word, accent_type):
+    """Returns the key of a grade. recording is either the uploaded bytes or the decoded signal."""
+    digest = hashlib.sha256()
+    digest.update(f"{grading_fingerprint()}|{word}|{accent_type}|".encode("utf-8"))
+    if isinstance(recording, np.ndarray):
+        recording = np.ascontiguousarray(recording)
+        digest.update(f"{recording.dtype}{recording.shape}|".encode("utf-8"))
+    else:
+        digest.update(b"upload|")
+    digest.update(recording)
+    return digest.hexdigest()
+
+def make_result(grade, coefficient=None, pitches=None, region=None):
+    """Returns what is cached of a grade: the grade itself and the features it came from."""
+    return {
+        "grade": grade,
+        "coefficient": None if coefficient is None else float(coefficient),
+        "pitches": None if pitches is None else [float(pitch) for pitch in pitches],
+        "region": None if region is None else [int(sample) for sample in region],
+    }
+
+
+class ResultCache():
+    """
+    Least recently used results in memory, optionally backed by a folder of json files.
+    Safe to use from several threads, and (for the folder) from several processes.
+    """
+    def __init__(self, size=RESULT_CACHE_SIZE, directory=RESULT_CACHE_DIRECTORY, disk_entries=RESULT_CACHE_DISK_ENTRIES):
+        self._size = size
+        self._directory = directory
+        self._disk_entries = disk_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._disk_count = len(os.listdir(directory))
+
+    def _path(self, key):
+        return os.path.join(self._directory, key + ".json")
+
+    def get(self, key):
+        """Returns the result stored under key, or None."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        if self._directory is None:
+            return None
+
+        try:
+            with open(self._path(key), encoding="utf-8") as file:
+                result = json.load(file)
+            os.utime(self._path(key)) # so pruning sees it as recently used
+        except (OSError, ValueError):
+            return None
+        self._remember(key, result)
+        return result
+
+    def put(self, key, result):
+        """Stores a result under key."""
+        self._remember(key, result)
+        if self._directory is None:
+            return
+
+        path = self._path(key)
+        is_new = not os.path.exists(path)
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump(result, file)
+        # replaced in one step, so another process never reads half a file.
+        os.replace(temporary, path)
+        if is_new:
+            with self._lock:
+                self._disk_count += 1
+                prune = self._disk_count > self._disk_entries
+            if prune:
+                self._prune()
+
+    def _remember(self, key, result):
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def _prune(self):
+        """Deletes the least recently used files until a tenth of RESULT_CACHE_DISK_ENTRIES is free."""
+        paths = []
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            try:
+                paths.append((os.path.getmtime(path), path))
+            except OSError:
+                pass # deleted by another process meanwhile
+        paths.sort()
+        excess = len(paths) - int(self._disk_entries * 0.9)
+        for _, path in paths[:max(excess, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_count = len(paths) - max(excess, 0)
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_result_cache():
+    """Returns the process-wide result cache, or None if it is turned off."""
+    global _cache
+    if RESULT_CACHE_SIZE <= 0 and RESULT_CACHE_DIRECTORY is None:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache()
+    return _cache
+
+def lookup(recording, word, accent_type):
+    """Looks up the grade of a recording (uploaded bytes or decoded signal).
+    Returns (key, result), where result is None if it hasn't been graded yet, and key is None if caching is off."""
+    cache = get_result_cache()
+    if cache is None:
+        return None, None
+    key = cache_key(recording, word, accent_type)
+    result = cache.get(key)
+    if result is not None:
+        print("found grade in result cache")
+    count("result_cache", result="miss" if result is None else "hit")
+    return key, result
+
+def store(keys, result):
+    """Stores a result under every one of keys that isn't None (see lookup)."""
+    cache = get_result_cache()
+    if cache is None:
+        return
+    for key in keys:
+        if key is not None:
+            cache.put(key, result)
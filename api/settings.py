@@ -1,21 +1,84 @@
 # Contains all parameters that can be adjusted to affect grading/the way algorithms work.
 
 # ~~~~~~~~~~~ PARAMETERS THAT AFFECT WHISPER ~~~~~~~~~~~
+ASR_BACKEND = "whisper" # speech recognition used by the pronunciation check. "whisper" (openai-whisper, fp32) or "faster_whisper" (CTranslate2, quantized, cpu friendly).
+ASR_COMPUTE_TYPE = "int8" # weight type the "faster_whisper" backend runs in. ie. "int8", "int8_float32", "float32".
 SELECTED_MODEL = "base" # model type used for whisper. one of "tiny", "base", "small", "medium", and "large".
+PRELOADED_MODELS = [SELECTED_MODEL] # models loaded once when the api starts instead of on the first grade.
+MODEL_POOL_SIZE = 2 # number of instances kept per model, so concurrent grades neither wait on one instance nor reload it.
+WHISPER_BATCH_SIZE = 8 # recordings run through whisper together in one forward pass when grading a batch.
+WHISPER_INPUT = "padded" # "padded" pads every recording to 30 seconds. "cropped" only encodes the voiced region (plus padding), so the encoder does far less work.
+WHISPER_MIN_AUDIO_CTX = 200 # with "cropped" input, the fewest encoder positions (20 ms each) whisper is given. very short contexts hurt accuracy.
+WHISPER_CROP_PADDING = 0.25 # with "cropped" input, seconds of audio kept either side of the voiced region.
+WARM_UP_MODELS = True # run one throwaway inference per instance at startup. the first inference on a fresh model is much slower.
+CONCURRENT_ASR = True # run the whisper check in a background thread while the recording is analysed, instead of after. the analysis stops early if whisper gives a coefficient of 0.
 
 # ~~~~~~~~~~~ PARAMETERS THAT AFFECT THE GRADE CALCULATION ~~~~~~~~~~~
 BASE_GRADE = 55 # the starting point for a non-zero coefficient grade
 CORRECT_LANGUAGE_WEIGHT = 0.6 # weight given to an answer that gets the correct language detected.
 CORRECT_TEXT_WEIGHT = 1 - CORRECT_LANGUAGE_WEIGHT # weight given to an answer that gets the correct input text detected.
 HIRAGANA_NOT_FOUND_PENALTY = 0.9 # penalty coefficient to which a grade should be multiplied if an expected hiragana is not found.
+KANA_CACHE_SIZE = 1024 # texts (ie. whisper transcriptions) whose hiragana and romaji conversions are kept in memory.
+PRONUNCIATION_SCORING = "transcription" # "transcription" compares whisper's free transcription to the expected text. "forced" scores the expected text's likelihood against similar readings in one decoder pass.
+DISTRACTOR_COUNT = 4 # with "forced" scoring, how many similar readings the expected text competes against.
 
 # ~~~~~~~~~~~ PARAMETERS THAT AFFECT THE AUDIO ANALYSIS ~~~~~~~~~~~
+SAMPLING_RATE = 22050 # rate, in Hz, that uploaded audio is decoded to. matches the librosa.load default.
+DECODER = "auto" # one of "pyav" (decode in process), "ffmpeg" (pool of pre-started ffmpeg processes), or "auto" (pyav when installed).
+FFMPEG_POOL_SIZE = 2 # ffmpeg processes kept started and waiting for input, when decoding with ffmpeg.
 # BUF_SIZE = 1024 # higher value means more frequency resolution
 # HOP_SIZE = 64 # lower value means larger rate of sampling
 # FRAME_SIZE = 2048  # values indicate duration of each analysis window
 HOP_LENGTH = 512 # values indicate spacing between consecutive analysis windows
 N_FFT = 1024 # number of bins to use in FFT
+FRONT_END_N_FFT = 2048 # number of bins in the single FFT shared by voice isolation, syllable splitting and the pitch track.
 FMIN = 40 # lower bound for frequency sampling
 FMAX = 1000 # upper bound for frequency sampling
+PITCH_ESTIMATOR = "yin" # one of "yin" (fast) or "pyin" (better voicing decisions, several times slower). used for the utterance pitch contour.
+PITCH_FRAME_LENGTH = 2048 # window length, in samples, of the pitch contour. must hold at least two periods of FMIN.
+VOICED_TOP_DB = 35 # frames quieter than this many dB below the loudest frame are treated as unvoiced.
+MORA_PITCH_STATISTIC = "median" # how a mora's pitch is summarised. one of "median", "trimmed_mean", or "middle_frame" (the old piptrack behaviour).
+PITCH_TRIM_PROPORTION = 0.2 # share of frames cut from each end before taking the trimmed mean.
 PITCH_TOLERANCE = 0.1 # indicates how close a pitch must be to its expected value. ie. 0.1 means it must be +/- 10% of the expected value.
-MINIMUM_DELTA = 1.5 # minimum expected change of pitch, in midi.
\ No newline at end of file
+MINIMUM_DELTA = 1.5 # minimum expected change of pitch, in midi.
+SEGMENTATION_MODE = "single_pass" # how PeakParse finds syllable peaks. "single_pass" keeps the most prominent peaks of one search, "iterative" is the original lowering-threshold loop.
+ENVELOPE_HOP = 128 # samples averaged into each point of the syllable envelope PeakParse searches. 1 keeps the full sample rate.
+GRADING_ENGINE = "peak_parse" # how a recording is split into mora. one of "peak_parse" (gaussian peak hunting) or "dtw" (align the contour to a reference, never fails to split).
+DTW_BAND = 0.2 # sakoe-chiba band of the dtw alignment, as a share of the longer contour. lower is faster but allows less timing difference.
+DTW_ENERGY_WEIGHT = 1.0 # weight of the energy envelope against the pitch contour when aligning.
+GATES = ["duration", "loudness", "voiced", "mora_count"] # cheap checks, run in this order, that turn away unusable recordings before any expensive stage. [] grades everything.
+MIN_DURATION = 0.3 # seconds. shorter recordings are rejected by the "duration" gate.
+MAX_DURATION = 10 # seconds. longer recordings are rejected by the "duration" gate.
+MIN_PEAK_RMS = 0.005 # rms the loudest frame must reach, or the "loudness" gate treats the recording as silent.
+CLIP_LEVEL = 0.99 # samples at or above this amplitude count as clipped.
+MAX_CLIPPED_FRACTION = 0.01 # share of clipped samples above which the "loudness" gate rejects a recording.
+MIN_VOICED_FRACTION = 0.05 # share of frames that must be voiced (see VOICED_TOP_DB) to pass the "voiced" gate.
+MIN_MORA_SECONDS = 0.04 # the "mora_count" gate rejects recordings with less voiced time than this per expected mora...
+MAX_MORA_SECONDS = 0.8 # ...or more than this per expected mora.
+
+# ~~~~~~~~~~~ PARAMETERS THAT AFFECT THE REFERENCE RECORDINGS ~~~~~~~~~~~
+WORD_LIST_DIRECTORY = "../jpp/public/words" # word lists (kanji, reading, pitch contour, ...) shared with the frontend.
+REFERENCE_AUDIO_DIRECTORIES = ["../jpp/public/audio/1+2 Noun", "samples"] # native speaker recordings, named <kanji>.wav.
+REFERENCE_INDEX_DIRECTORY = "reference_index" # where reference_index.py stores the precomputed reference features.
+REFERENCE_WEIGHT = 0 # share of the pitch grade that comes from comparing against the native reference. 0 turns it off.
+
+
+# ~~~~~~~~~~~ PARAMETERS THAT AFFECT THE SERVER ~~~~~~~~~~~
+STARTUP_MODE = "preload" # "preload" loads the models and warms up the signal processing before serving. "lazy" starts serving right away and loads everything on the first grade.
+SERVER_MODE = "inline" # one of "inline" (grade inside the flask thread) or "pool" (send each grade to a worker process).
+WORKER_COUNT = 4 # number of worker processes used in "pool" mode. each one loads its own copy of the whisper model.
+MAX_QUEUED_JOBS = 8 # grades allowed to wait for a free worker. any more than that are turned away with a 429.
+QUEUE_TIMEOUT = 0 # seconds a grade may wait for room in the queue before being turned away. 0 means don't wait.
+BATCH_MAX_ITEMS = 50 # most recordings accepted by one /grade/batch request.
+MAX_UPLOAD_BYTES = 32 * 1024 * 1024 # largest request body accepted (a recording, a stream chunk or a whole batch). larger ones are turned away with a 413.
+BATCH_DSP_WORKERS = 4 # threads used to decode and analyse the recordings of a batch in parallel.
+MAX_STREAMS = 32 # most recordings that can be streaming in at once.
+STREAM_TIMEOUT = 60 # seconds a stream can go without a new chunk before it is dropped.
+JOB_WORKERS = 2 # threads running the grades queued through /jobs. in "pool" mode they hand the grades to the worker processes.
+JOB_QUEUE_SIZE = 32 # grades allowed to wait in the /jobs queue. any more than that are turned away with a 429.
+JOB_RESULT_TTL = 300 # seconds a finished job's result can still be polled.
+
+# ~~~~~~~~~~~ PARAMETERS THAT AFFECT THE RESULT CACHE ~~~~~~~~~~~
+RESULT_CACHE_SIZE = 256 # finished grades kept in memory, keyed by the recording, word, accent type and every setting above that changes a grade. 0 keeps none in memory.
+RESULT_CACHE_DIRECTORY = None # folder grades are also cached in, so they survive restarts and are shared by worker processes. None keeps them in memory only.
+RESULT_CACHE_DISK_ENTRIES = 10000 # most grades kept in RESULT_CACHE_DIRECTORY. the least recently used are deleted first.
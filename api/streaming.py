@@ -0,0 +1,171 @@
+import time
+import uuid
+import threading
+
+import librosa
+import numpy as np
+from settings import SAMPLING_RATE, FRONT_END_N_FFT, HOP_LENGTH, FMIN, FMAX, PITCH_FRAME_LENGTH, PITCH_ESTIMATOR
+from settings import MAX_STREAMS, STREAM_TIMEOUT
+from analysis import voiced_frames
+from decoding import open_streaming_decoder
+
+"""
+Streaming ingest.
+The recorder sends its chunks while the student is still speaking. Each stream keeps one decoder
+running, and every chunk advances a rolling analysis that computes the stft and pitch contour
+frames that are already complete. By the time the recording stops, only the last few frames,
+the voice isolation mask and whisper are left to do (see grading.grade_stream, which can run on a worker).
+"""
+
+class StreamLimitError(Exception):
+    """Raised when too many streams are open at once."""
+    pass
+
+class UnknownStreamError(Exception):
+    """Raised when a stream id doesn't exist (or has expired)."""
+    pass
+
+def _padded_slice(y, start, end, pad):
+    """Returns samples start:end of y with `pad` zeros in front of it (and behind it, when end runs past y),
+    the same padding librosa applies to a centered stft."""
+    out = np.zeros(end - start, dtype=np.float32)
+    lo = max(start - pad, 0)
+    hi = min(end - pad, len(y))
+    if hi > lo:
+        out[lo + pad - start:hi + pad - start] = y[lo:hi]
+    return out
+
+
+class RollingAnalysis():
+    """
+    Computes stft and pitch contour frames as samples arrive.
+    Frames only depend on the samples under their window, so every frame whose window is complete
+    can be computed early. The frames match librosa.stft / get_pitch_contour on the finished signal exactly.
+    """
+    def __init__(self, sampling_rate=SAMPLING_RATE):
+        self._sampling_rate = sampling_rate
+        self._signal = np.zeros(0, dtype=np.float32)
+        self._stft = []
+        self._stft_frames = 0
+        self._f0 = []
+        self._rms = []
+        self._pitch_frames = 0
+
+    @property
+    def signal(self):
+        return self._signal
+
+    def extend(self, samples):
+        """Adds newly decoded samples and computes every frame that is now complete."""
+        if len(samples):
+            self._signal = np.concatenate((self._signal, samples))
+            self._advance(final=False)
+
+    def _new_frames(self, done, frame_length, final):
+        """Returns the range of frames that can be computed now, for a window of frame_length."""
+        pad = frame_length // 2
+        available = len(self._signal) + pad + (pad if final else 0)
+        total = 0 if available < frame_length else 1 + (available - frame_length) // HOP_LENGTH
+        return done, total
+
+    def _advance(self, final):
+        first, last = self._new_frames(self._stft_frames, FRONT_END_N_FFT, final)
+        if last > first:
+            segment = _padded_slice(self._signal, first * HOP_LENGTH, (last - 1) * HOP_LENGTH + FRONT_END_N_FFT, FRONT_END_N_FFT // 2)
+            self._stft.append(librosa.stft(segment, n_fft=FRONT_END_N_FFT, hop_length=HOP_LENGTH, center=False))
+            self._stft_frames = last
+
+        if PITCH_ESTIMATOR != "yin":
+            # pyin decodes the whole contour at once, so it can only run on the finished signal.
+            return
+
+        first, last = self._new_frames(self._pitch_frames, PITCH_FRAME_LENGTH, final)
+        if last > first:
+            segment = _padded_slice(self._signal, first * HOP_LENGTH, (last - 1) * HOP_LENGTH + PITCH_FRAME_LENGTH, PITCH_FRAME_LENGTH // 2)
+            self._f0.append(librosa.yin(segment, fmin=FMIN, fmax=FMAX, sr=self._sampling_rate,
+                                        frame_length=PITCH_FRAME_LENGTH, hop_length=HOP_LENGTH, center=False))
+            self._rms.append(librosa.feature.rms(y=segment, frame_length=PITCH_FRAME_LENGTH, hop_length=HOP_LENGTH, center=False)[0])
+            self._pitch_frames = last
+
+    def finish(self):
+        """Computes the frames that needed the end of the signal.
+        Returns (signal, stft, pitch_contour), what a SpectralFrontEnd of the whole recording is built from.
+        pitch_contour is None when the pitch estimator can't run ahead (see _advance)."""
+        self._advance(final=True)
+
+        pitch_contour = None
+        if self._f0:
+            f0 = np.concatenate(self._f0)
+            pitch_contour = (f0, voiced_frames(np.concatenate(self._rms)))
+
+        return self._signal, np.concatenate(self._stft, axis=1), pitch_contour
+
+
+class StreamSession():
+    """
+    One recording being streamed in. Holds its decoder and rolling analysis.
+    """
+    def __init__(self):
+        self._decoder = open_streaming_decoder()
+        self._analysis = RollingAnalysis()
+        self._lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+    def add_chunk(self, chunk):
+        """Decodes a chunk and analyses whatever new audio it produced. Returns the number of samples so far."""
+        with self._lock:
+            self.last_used = time.monotonic()
+            self._decoder.feed(chunk)
+            self._analysis.extend(self._decoder.take())
+            return len(self._analysis.signal)
+
+    def finish(self):
+        """Ends the stream and returns its (signal, stft, pitch_contour) (see RollingAnalysis.finish)."""
+        with self._lock:
+            self._analysis.extend(self._decoder.close())
+            return self._analysis.finish()
+
+    def abort(self):
+        self._decoder.abort()
+
+
+class StreamRegistry():
+    """
+    Keeps the open streams of this process. Streams left idle longer than STREAM_TIMEOUT are dropped.
+    """
+    def __init__(self, max_streams=MAX_STREAMS, timeout=STREAM_TIMEOUT):
+        self._max_streams = max_streams
+        self._timeout = timeout
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        now = time.monotonic()
+        for stream_id, session in list(self._streams.items()):
+            if now - session.last_used > self._timeout:
+                del self._streams[stream_id]
+                session.abort()
+
+    def open(self):
+        """Starts a new stream and returns its id."""
+        with self._lock:
+            self._expire()
+            if len(self._streams) >= self._max_streams:
+                raise StreamLimitError("too many recordings are streaming right now, try again shortly.")
+            stream_id = uuid.uuid4().hex
+            self._streams[stream_id] = StreamSession()
+        return stream_id
+
+    def get(self, stream_id):
+        with self._lock:
+            session = self._streams.get(stream_id)
+        if session is None:
+            raise UnknownStreamError("unknown or expired stream.")
+        return session
+
+    def pop(self, stream_id):
+        with self._lock:
+            session = self._streams.pop(stream_id, None)
+        if session is None:
+            raise UnknownStreamError("unknown or expired stream.")
+        return session
@@ -0,0 +1,16 @@
+import pytest
+from catalog import get_catalog, UnknownWordError
+
+"""
+Checks that a grade request's word resolves to the accent type it should be graded against.
+Run from the api folder: python -m pytest test_catalog.py
+"""
+
+def test_kanji_resolves_to_its_own_accent_type():
+    assert get_catalog().resolve("日本") == ("にほんです", 2)
+    assert get_catalog().resolve("二本") == ("にほんです", 1)
+
+def test_homophone_reading_needs_accent_type():
+    with pytest.raises(UnknownWordError, match="ambiguous"):
+        get_catalog().resolve("にほんです")
+    assert get_catalog().resolve("にほんです", 1) == ("にほんです", 1)
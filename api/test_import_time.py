@@ -0,0 +1,44 @@
+import sys
+import json
+import subprocess
+
+"""
+Checks that the api process starts fast.
+Imports the api in fresh interpreters with STARTUP_MODE = "lazy" (so no model is loaded) and fails if
+    the import takes longer than IMPORT_TIME_BUDGET, or
+    a module the api only needs for plotting or for the first grade (matplotlib, whisper, torch) got imported.
+Run from the api folder, ie. before merging anything that adds an import:
+    python -m pytest test_import_time.py
+If the budget is exceeded, `python -X importtime -c 'import api'` shows where the time goes.
+"""
+
+IMPORT_TIME_BUDGET = 2.0 # seconds
+DEFERRED_MODULES = ["matplotlib", "whisper", "torch", "faster_whisper"]
+RUNS = 3 # fresh interpreters to time. the fastest one counts
+
+MEASURE = """
+import sys, time, json
+import settings
+settings.STARTUP_MODE = "lazy"
+settings.SERVER_MODE = "inline"
+start = time.perf_counter()
+import api
+seconds = time.perf_counter() - start
+print(json.dumps({"seconds": seconds, "loaded": [name for name in %r if name in sys.modules]}))
+"""
+
+def measure(runs=RUNS):
+    """Imports the api in `runs` fresh interpreters. Returns (fastest seconds, deferred modules that got loaded)."""
+    best, loaded = None, set()
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", MEASURE % DEFERRED_MODULES],
+                                check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        best = result["seconds"] if best is None else min(best, result["seconds"])
+        loaded.update(result["loaded"])
+    return best, sorted(loaded)
+
+def test_import_time():
+    seconds, loaded = measure()
+    assert not loaded, f"imported at startup but should be deferred: {', '.join(loaded)}"
+    assert seconds <= IMPORT_TIME_BUDGET, f"api imported in {seconds:.2f}s, over the {IMPORT_TIME_BUDGET:.2f}s budget"
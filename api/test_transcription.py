@@ -0,0 +1,17 @@
+from preprocessing import score_transcription
+from utilities import text_to_hiragana, text_to_romaji
+
+"""
+Checks that scoring whisper's transcription against the expected text only gives full credit for the whole phrase.
+Run from the api folder: python -m pytest test_transcription.py
+"""
+
+def test_bare_kanji_reads_without_desu():
+    assert text_to_hiragana("日本") == "にほん"
+    assert text_to_romaji("日本") == "nihon"
+    assert text_to_hiragana("日本です") == "にほんです"
+
+def test_transcription_missing_desu_scores_below_full():
+    assert score_transcription("ja", "日本です", "にほんです") == 1
+    assert score_transcription("ja", "日本", "にほんです") < 1
+    assert score_transcription("en", "nihon", "にほんです") < score_transcription("en", "nihondesu", "にほんです")
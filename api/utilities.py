@@ -1,8 +1,7 @@
-import pykakasi
-import numpy as np
-import matplotlib.pyplot as plt
+import threading
+from functools import lru_cache
 from difflib import SequenceMatcher
-from settings import HIRAGANA_NOT_FOUND_PENALTY
+from settings import HIRAGANA_NOT_FOUND_PENALTY, KANA_CACHE_SIZE
 
 vowels = ['あ', 'い', 'う', 'え', 'お', 'ん']
 skip = ['ゃ', 'ゅ', 'ょ']
@@ -46,34 +45,44 @@ data = [
 
 def plot(pitches):
     """Given a set of pitches, plot them equally spaced in time to see a visualization of the pitch over time."""
-    time_axis = np.arange(len(pitches))
-    plt.scatter(time_axis, pitches)
+    from plotting import plot_pitches
+    plot_pitches(pitches)
 
-    plt.ylabel("Pitch")
-    plt.title("Pitch vs. Time")
-
-    plt.show()
+_kakasi = None
+_kakasi_lock = threading.Lock()
 
 def get_kanji_info(input_text):
-    kks = pykakasi.kakasi()
-    result = kks.convert(input_text)
-    return result
+    """Returns pykakasi's conversion of the text, one dict per word (with 'hira', 'hepburn', ...).
+    Every call shares one converter, which takes a while to set up."""
+    global _kakasi
+    with _kakasi_lock:
+        if _kakasi is None:
+            import pykakasi
+            _kakasi = pykakasi.kakasi()
+        return _kakasi.convert(input_text)
 
-def text_to_hiragana(input_text):
-    """Given a set of Japanese hiragana, katakana, and kanji, returns the string in all hiragana characters."""
+@lru_cache(maxsize=KANA_CACHE_SIZE)
+def convert(input_text):
+    """Given a set of Japanese hiragana, katakana, and kanji, returns the tuple (hiragana, romaji). Cached."""
     info = get_kanji_info(input_text)
-    hiragana_string = ""
-    for word in info:
-        hiragana_string += word['hira']
-    return hiragana_string
+    return "".join(word['hira'] for word in info), "".join(word['hepburn'] for word in info)
+
+def text_to_hiragana(input_text):
+    """Given a set of Japanese hiragana, katakana, and kanji, returns the string in all hiragana characters.
+    Words in the lexicon use their known reading instead of pykakasi's guess."""
+    from lexicon import get_lexicon
+    spelling = get_lexicon().spelling(input_text)
+    if spelling is not None:
+        return spelling[0]
+    return convert(input_text)[0]
 
 def text_to_romaji(input_text):
     """Given a set of Japanese hiragana, katakana, and kanji, returns the string in all romaji characters."""
-    info = get_kanji_info(input_text)
-    romaji_string = ""
-    for word in info:
-        romaji_string += word['hepburn']
-    return romaji_string
+    from lexicon import get_lexicon
+    spelling = get_lexicon().spelling(input_text)
+    if spelling is not None:
+        return spelling[1]
+    return convert(input_text)[1]
 
 
 def compare_hiragana_strings(input, expected):
@@ -0,0 +1,74 @@
+import os
+from settings import WORD_LIST_DIRECTORY
+
+"""
+Reads the word lists the frontend serves from jpp/public/words.
+Each word is a record of lines, and records are separated by a "ーーー" line:
+    美術                        kanji
+    び・じゅ・つ・で・す          reading, split into mora by "・"
+    1^ .8125 .625 .4375 .25     relative pitch of each mora. "^" marks the accented mora.
+    art                         english
+    1+2 Noun                    category
+    美・び                       reading of each kanji (any number of lines)
+"""
+
+RECORD_SEPARATOR = "ーーー"
+MORA_SEPARATOR = "・"
+ACCENT_MARK = "^"
+SUFFIX = ["で", "す"]
+
+def accent_type_from_contour(mora, contour_marks):
+    """Given the mora of a reading and the marks of its contour line, returns the accent type used by grade_pitch_pattern.
+    The accent type is the (1-based) mora the pitch drops after, or 0 (heiban) when it only drops on the です suffix."""
+    for i, mark in enumerate(contour_marks):
+        if mark.endswith(ACCENT_MARK):
+            position = i + 1
+            if mora[-len(SUFFIX):] == SUFFIX and position > len(mora) - len(SUFFIX):
+                return 0
+            return position
+    return 0
+
+def parse_record(lines):
+    """Given the lines of one record, returns a dict describing the word."""
+    kanji, reading, contour, english, category = lines[:5]
+    mora = reading.split(MORA_SEPARATOR)
+    contour_marks = contour.split()
+
+    return {
+        "kanji": kanji,
+        "reading": "".join(mora),
+        "mora": mora,
+        "contour": [float(mark.rstrip(ACCENT_MARK)) for mark in contour_marks],
+        "accent_type": accent_type_from_contour(mora, contour_marks),
+        "english": english,
+        "category": category,
+        "kanji_readings": [tuple(line.split(MORA_SEPARATOR, 1)) for line in lines[5:]],
+    }
+
+def read_word_list(path):
+    """Given the path to a word list file, returns a list of word dicts (see parse_record)."""
+    words = []
+    record = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line == RECORD_SEPARATOR:
+                if record:
+                    words.append(parse_record(record))
+                record = []
+            elif line:
+                record.append(line)
+    if len(record) >= 5:
+        words.append(parse_record(record))
+    return words
+
+def word_list_paths(directory=WORD_LIST_DIRECTORY):
+    """Returns the paths of every word list in the directory, in a stable order."""
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith(".txt")]
+
+def load_word_lists(directory=WORD_LIST_DIRECTORY):
+    """Returns the words of every word list in the directory."""
+    words = []
+    for path in word_list_paths(directory):
+        words += read_word_list(path)
+    return words
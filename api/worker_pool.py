@@ -0,0 +1,108 @@
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from settings import WORKER_COUNT, MAX_QUEUED_JOBS, QUEUE_TIMEOUT
+from metrics import collect, merge
+
+"""
+Worker-pool server mode.
+Grading is cpu bound (stft, nn_filter, piptrack, whisper), so in "pool" mode the flask process only
+handles requests and every grade job runs in one of WORKER_COUNT worker processes. Each worker keeps
+its own whisper model loaded. Jobs run in the worker's working directory (the api folder), so the
+relative paths in settings.py (ie. the reference index and the result cache folder) mean the same as in flask.
+"""
+
+class PoolBusyError(Exception):
+    """Raised when every worker is busy and the queue of waiting jobs is full."""
+    pass
+
+def _init_worker(worker_count):
+    """Runs once in every worker process. Loads the whisper model, warms up the signal processing, builds the lexicon
+    and opens the reference index and result cache so jobs never wait on them."""
+    from model_registry import preload_models, limit_torch_threads
+    from front_end import warm_up_front_end
+    from lexicon import get_lexicon
+    from reference_index import get_reference_index
+    from result_cache import get_result_cache
+
+    # a worker only runs one job at a time, so it only needs one model instance.
+    preload_models(size=1)
+    limit_torch_threads(worker_count)
+    warm_up_front_end()
+    get_lexicon()
+    get_reference_index()
+    get_result_cache()
+
+def _run_job(fn, args, kwargs):
+    """Runs fn. Returns (result, collection) so the stage timings and counts make it back to the flask process."""
+    with collect() as collection:
+        return fn(*args, **kwargs), collection
+
+
+class GradeWorkerPool():
+    """
+    Runs jobs in a pool of worker processes with a bounded queue in front of it.
+    At most `workers` jobs run at once and at most `max_queued` more wait for a worker.
+    Anything past that raises PoolBusyError instead of piling up behind the busy workers.
+    """
+    def __init__(self, workers=WORKER_COUNT, max_queued=MAX_QUEUED_JOBS, queue_timeout=QUEUE_TIMEOUT):
+        self._workers = workers
+        self._queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(workers + max_queued)
+        # spawn instead of fork so workers never inherit torch state from the flask process.
+        self._executor = ProcessPoolExecutor(max_workers=workers,
+                                             mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=_init_worker,
+                                             initargs=(workers,))
+
+    def submit(self, fn, *args, **kwargs):
+        """Queues fn(*args, **kwargs) to run on a worker and returns its future, which resolves to (result, collection).
+        fn must be importable at module level so it can be sent to the worker."""
+        if self._queue_timeout:
+            acquired = self._slots.acquire(timeout=self._queue_timeout)
+        else:
+            acquired = self._slots.acquire(blocking=False)
+        if not acquired:
+            raise PoolBusyError("all workers are busy, try again shortly.")
+
+        try:
+            future = self._executor.submit(_run_job, fn, args, kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def run(self, fn, *args, **kwargs):
+        """Runs fn on a worker and waits for its result. Exceptions raised by fn are raised here.
+        The stage timings and counts of the job are recorded in this process."""
+        result, collection = self.submit(fn, *args, **kwargs).result()
+        merge(collection)
+        return result
+
+    def run_each(self, fn, args_list):
+        """Runs fn(*args) for every args in args_list on the workers at once, and waits for all of them.
+        Returns their results in order. If the pool can't take all of them, none run and PoolBusyError is raised."""
+        futures = []
+        try:
+            for args in args_list:
+                futures.append(self.submit(fn, *args))
+        except PoolBusyError:
+            for future in futures:
+                future.cancel()
+            raise
+
+        results = []
+        for future in futures:
+            result, collection = future.result()
+            merge(collection)
+            results.append(result)
+        return results
+
+    @property
+    def workers(self):
+        return self._workers
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
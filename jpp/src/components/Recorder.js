@@ -7,11 +7,11 @@ import axios from 'axios';
 
 function Recorder() {
   const [word, setWord] = useState('');
-  const [accentType, setAccentType] = useState(0);
-  const [reader, setReader] = useState(null);
+  const [accentType, setAccentType] = useState('');
   const [grade, setGrade] = useState(null);
 
   const mimeType = "audio/webm";
+  const chunkInterval = 250; // ms of audio per streamed chunk
   const [stream, setStream] = useState();
   const mediaRecorder = useRef();
   const [permission, setPermission] = useState(false);
@@ -20,6 +20,10 @@ function Recorder() {
   const [audioBlob, setAudioBlob] = useState(null);
   const [error, setError] = useState(null);
 
+  // chunks are streamed to the api while recording so it can analyse them before the grade is requested.
+  const streamId = useRef(null);
+  const uploads = useRef(Promise.resolve());
+
   useEffect(() => {
     getUserPermission();
   }, []);
@@ -56,11 +60,44 @@ function Recorder() {
     }
   };
 
-  const startRecording = () => {
+  const openStream = async () => {
+    try {
+      const response = await axios.post('/streams');
+      return response.data.stream_id;
+    } catch (error) {
+      // streaming is an optimisation. fall back to uploading the whole recording on grade.
+      console.error('Error opening stream:', error);
+      return null;
+    }
+  };
+
+  // throws away a stream that won't be graded, so it doesn't hold one of the api's stream slots until it times out.
+  const cancelStream = (id) => {
+    axios.delete(`/streams/${id}`).catch((error) => console.error('Error cancelling stream:', error));
+  };
+
+  useEffect(() => {
+    // leaving the page abandons the recording.
+    return () => {
+      if (streamId.current) {
+        cancelStream(streamId.current);
+      }
+    };
+  }, []);
+
+  const startRecording = async () => {
     const media = new MediaRecorder(stream, { mimeType: mimeType });
     mediaRecorder.current = media;
 
-    mediaRecorder.current.start();
+    // a new recording replaces one that was never graded.
+    if (streamId.current) {
+      cancelStream(streamId.current);
+      streamId.current = null;
+    }
+    streamId.current = await openStream();
+    uploads.current = Promise.resolve();
+
+    mediaRecorder.current.start(chunkInterval);
     console.log(mediaRecorder.current.state);
     console.log("recorder started");
 
@@ -68,6 +105,21 @@ function Recorder() {
 
     mediaRecorder.current.ondataavailable = (e) => {
       localChunks.push(e.data);
+
+      const id = streamId.current;
+      if (id) {
+        // chain the uploads so chunks reach the api in order.
+        uploads.current = uploads.current.then(() =>
+          axios.post(`/streams/${id}/chunks`, e.data, { headers: { 'Content-Type': mimeType } })
+        ).catch((error) => {
+          console.error('Error streaming chunk:', error);
+          // the recording will be uploaded whole instead, so the half-streamed copy can go.
+          if (streamId.current === id) {
+            streamId.current = null;
+            cancelStream(id);
+          }
+        });
+      }
     };
 
     setChunks(localChunks);
@@ -81,16 +133,11 @@ function Recorder() {
     mediaRecorder.current.onstop = (e) => {
       const audioBlob = new Blob(chunks, { type: mimeType });
       setAudioBlob(audioBlob);
-
-      const reader = new FileReader();
-      reader.readAsDataURL(audioBlob);
-      setReader(reader);
-
     };
   };
 
   const handleGrade = async () => {
-    if (!reader) {
+    if (!audioBlob) {
       setError('Please record audio before grading.');
       return;
     }
@@ -102,13 +149,28 @@ function Recorder() {
 
     const formData = new FormData();
     formData.append('word', word);
-    formData.append('accent_type', accentType);
-    formData.append('sf', reader.result);
+    // the api looks up the accent type of words in its catalog, so it only needs sending to override that.
+    if (accentType !== '') {
+      formData.append('accent_type', accentType);
+    }
 
     try {
-      const response = await axios.post('/grade', formData, {
-        headers: { 'Content-Type': 'multipart/form-data' }
-      });
+      await uploads.current;
+      const id = streamId.current;
+      let response;
+      if (id) {
+        // the api already has (and has mostly analysed) the recording.
+        streamId.current = null;
+        response = await axios.post(`/streams/${id}/finish`, formData, {
+          headers: { 'Content-Type': 'multipart/form-data' }
+        });
+      } else {
+        // send the recording as a binary file rather than a base64 data url.
+        formData.append('sf', audioBlob, 'recording.webm');
+        response = await axios.post('/grade', formData, {
+          headers: { 'Content-Type': 'multipart/form-data' }
+        });
+      }
       const { grade } = response.data;
       setGrade(grade);
     } catch (error) {
@@ -121,7 +183,8 @@ function Recorder() {
       <InputLabel htmlFor="word">Word:</InputLabel>
       <TextField id="word" label="Enter a word" variant="outlined" value={word} onChange={(e) => setWord(e.target.value)}/>
       <InputLabel htmlFor="accentType">Accent Type:</InputLabel>
-      <Select id="accentType" value={accentType} onChange={(e) => setAccentType(e.target.value)}>
+      <Select id="accentType" value={accentType} displayEmpty onChange={(e) => setAccentType(e.target.value)}>
+        <MenuItem value="">Auto</MenuItem>
         <MenuItem value="0">0</MenuItem>
         <MenuItem value="1">1</MenuItem>
         <MenuItem value="2">2</MenuItem>
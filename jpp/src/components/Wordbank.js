@@ -3,28 +3,26 @@ import { useEffect, useState } from "react";
 import axios from 'axios';
 
 function WordBank() {
-  const [words, setWords] = useState();
-
-  async function parseData(txt) {
-    setWords(txt);
-  }
+  const [words, setWords] = useState([]);
 
   useEffect(() => {
     async function fetchData() {
-      const response = await axios.get('http://localhost:3000/words/1+2noun.txt');
-      await parseData(response.data);
+      // the api compiles the word lists into one catalog, so nothing is parsed here.
+      // it is revalidated by ETag, so an unchanged catalog comes back as a 304 from the browser cache.
+      const response = await axios.get('/words');
+      setWords(response.data.words);
     }
     fetchData()
   }, []);
 
-  console.log(words)
-
   return (
     <Box>
       <Grid container spacing={{ xs: 2, md: 3 }} columns={{ xs: 4, sm: 8, md: 12 }}>
-        {Array.from(Array(12)).map((_, index) => (
-          <Grid item xs={2} sm={4} md={4} key={index}>
-            <Box>H</Box>
+        {words.filter((word) => word.category).map((word) => (
+          <Grid item xs={2} sm={4} md={4} key={word.kanji}>
+            <Box>{word.kanji}</Box>
+            <Box>{word.mora.join('・')}</Box>
+            <Box>{word.english}</Box>
           </Grid>
         ))}
       </Grid>
@@ -32,4 +30,4 @@ function WordBank() {
   );
 }
 
-export default WordBank;
\ No newline at end of file
+export default WordBank;